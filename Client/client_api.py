@@ -0,0 +1,265 @@
+"""Headless VegSecAI client: the connection and protocol logic without the Tk interface.
+
+    with VegSecAIClient("192.168.1.10") as client:
+        client.login("alice", "secret")
+        print(client.analyze("carrot.jpg"))
+"""
+import hashlib
+import json
+import socket
+import ssl
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from protocol import (
+    FRAME_TEXT, FRAME_IMAGE, FRAME_BYE, FRAME_END, FRAME_ERROR, FRAME_HISTORY, FRAME_THUMBNAIL,
+    recv_frame, recv_text, send_frame, send_frames, send_texts
+)
+from upload_utils import DEFAULT_MAX_EDGE, choose_upload_format, prepare_upload
+
+SERVER_PORT = 12378
+DEFAULT_QUESTION = "What vegetable is this?"
+PIPELINE_WINDOW = 8  # Image requests sent ahead of their answers
+HISTORY_PAGE_SIZE = 200
+UPLOAD_SETTINGS_TIMEOUT = 10  # seconds; the defaults are used rather than waiting on a busy server
+
+# Function declarations:
+# def create_client_ssl_context() -> ssl.SSLContext
+# def open_connection(host: str, port: int = SERVER_PORT, timeout: float | None = None) -> ssl.SSLSocket
+# def fetch_upload_settings(host: str, port: int = SERVER_PORT, timeout: float | None = UPLOAD_SETTINGS_TIMEOUT) -> dict
+# def fetch_history_page(host: str, port: int, session_token: str, cursor: str = "", page_size: int = HISTORY_PAGE_SIZE) -> dict
+# def is_failed_answer(frame_type: int, answer: str) -> bool
+# class VegSecAIClient(host: str, port: int = SERVER_PORT, timeout: float | None = None)
+
+
+class LoginError(Exception):
+    """Raised when the server rejects a login"""
+
+
+def create_client_ssl_context():
+    # The server uses a self-signed certificate
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def open_connection(host, port=SERVER_PORT, timeout=None):
+    """Open an SSL connection to the server"""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    return create_client_ssl_context().wrap_socket(sock)
+
+
+def fetch_upload_settings(host, port=SERVER_PORT, timeout=UPLOAD_SETTINGS_TIMEOUT):
+    """Ask the server how large uploads may be and which formats it accepts"""
+    settings = {"max_edge": DEFAULT_MAX_EDGE, "formats": ["jpeg", "png"]}
+    sock = None
+    try:
+        sock = open_connection(host, port, timeout)
+        send_texts(sock, ["upload_settings"])
+        settings.update(json.loads(recv_text(sock)))
+    except Exception as e:
+        # Older servers do not know the request; the defaults suit them
+        # stderr, so it never mixes with a caller's output on stdout
+        print(f"Using default upload settings: {e}", file=sys.stderr)
+    finally:
+        if sock:
+            sock.close()
+    return settings
+
+
+def fetch_history_page(host, port, session_token, cursor="", page_size=HISTORY_PAGE_SIZE):
+    """Fetch one history page as {"entries", "thumbnails", "next_cursor"} over its own connection.
+    session_token is the one received at login; it is only valid while that session is open."""
+    sock = open_connection(host, port)
+    try:
+        send_texts(sock, ["get_history", session_token, cursor, str(page_size)])
+
+        # Entries arrive in batches with their thumbnails, followed by an end frame
+        # carrying the next page cursor
+        entries = []
+        thumbnails = {}
+        next_cursor = ""
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                # Only the end frame finishes a page; stopping here would silently truncate the history
+                raise ConnectionError("Server closed the connection before the end of the history page")
+
+            frame_type, _, payload = frame
+            if frame_type == FRAME_ERROR:
+                raise RuntimeError(payload.decode())
+            if frame_type == FRAME_END:
+                next_cursor = payload.decode()
+                break
+
+            if frame_type == FRAME_HISTORY:
+                entries.extend(json.loads(payload))
+            elif frame_type == FRAME_THUMBNAIL:
+                thumbnails[bytes(payload[:64]).decode()] = bytes(payload[64:])
+        return {"entries": entries, "thumbnails": thumbnails, "next_cursor": next_cursor}
+    finally:
+        sock.close()
+
+
+def is_failed_answer(frame_type, answer):
+    """Tell whether an image reply reports a failure rather than an answer"""
+    return (frame_type == FRAME_ERROR or answer == "Image hash mismatch."
+            or answer.startswith("Invalid image format"))
+
+
+class VegSecAIClient:
+    """One logged-in session with the server"""
+
+    def __init__(self, host, port=SERVER_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.username = None
+        self.session_token = None
+        self.upload_settings = None
+        self.next_request_id = 1
+
+    @classmethod
+    def from_socket(cls, sock, host, port=SERVER_PORT, username=None, session_token=None):
+        """Wrap a connection that has already logged in, such as the GUI's"""
+        client = cls(host, port)
+        client.sock = sock
+        client.username = username
+        client.session_token = session_token
+        return client
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def login(self, username, password):
+        """Open the session connection and log in, raising LoginError on rejection"""
+        self.sock = open_connection(self.host, self.port, self.timeout)
+        send_texts(self.sock, ["login", username, password])
+        response = recv_text(self.sock)
+        if response != "Login successful":
+            self.sock.close()
+            self.sock = None
+            raise LoginError(response)
+        self.session_token = recv_text(self.sock)
+        self.username = username
+
+    def close(self):
+        """Log out (if logged in) and close the connection"""
+        if self.sock:
+            try:
+                send_frame(self.sock, FRAME_BYE)
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+    def prepare(self, image_path):
+        """Downscale and re-encode an image the way the server asks for"""
+        if self.upload_settings is None:
+            self.upload_settings = fetch_upload_settings(self.host, self.port, self.timeout or UPLOAD_SETTINGS_TIMEOUT)
+        return prepare_upload(image_path, self.upload_settings["max_edge"],
+                              choose_upload_format(self.upload_settings["formats"]))
+
+    def send_image(self, image_data, question=DEFAULT_QUESTION):
+        """Send one image request without waiting for the answer and return its request id"""
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        send_frames(self.sock, [
+            (FRAME_IMAGE, image_data, request_id),
+            (FRAME_TEXT, hashlib.sha256(image_data).hexdigest().encode(), request_id),
+            (FRAME_TEXT, question.encode(), request_id),
+        ])
+        return request_id
+
+    def receive_answer(self):
+        """Wait for the next image reply and return (request_id, failed, answer)"""
+        frame = recv_frame(self.sock)
+        if frame is None:
+            raise ConnectionError("Server closed the connection")
+        frame_type, request_id, payload = frame
+        answer = payload.decode()
+        return request_id, is_failed_answer(frame_type, answer), answer
+
+    def analyze(self, image_path, question=DEFAULT_QUESTION):
+        """Ask a question about one image and return the answer, raising RuntimeError on failure"""
+        request_id = self.send_image(self.prepare(image_path), question)
+        while True:
+            reply_id, failed, answer = self.receive_answer()
+            if reply_id == request_id:
+                break
+        if failed:
+            raise RuntimeError(answer)
+        return answer
+
+    def analyze_many(self, image_paths, question=DEFAULT_QUESTION, window=PIPELINE_WINDOW, prepare_workers=0,
+                     on_sent=None, on_result=None):
+        """Pipeline many images over the session, yielding (path, failed, answer) as answers arrive.
+
+        With prepare_workers, the next images are downscaled in that many threads while earlier ones
+        are on the wire. on_sent(index, path) and on_result(index, path, failed, answer) receive the
+        image's position in image_paths, e.g. to update a progress view.
+        """
+        image_paths = list(image_paths)
+        window = max(1, window)
+        executor = None
+        if prepare_workers > 0 and image_paths:
+            # Fetch the settings once here rather than racing to fetch them from every worker
+            if self.upload_settings is None:
+                self.upload_settings = fetch_upload_settings(self.host, self.port,
+                                                             self.timeout or UPLOAD_SETTINGS_TIMEOUT)
+            executor = ThreadPoolExecutor(max_workers=prepare_workers, thread_name_prefix="prepare")
+        prepared = {}  # index -> Future of the bytes to send
+        in_flight = {}  # request id -> index of the image it carries
+        next_index = 0
+
+        def result(index, failed, answer):
+            if on_result is not None:
+                on_result(index, image_paths[index], failed, answer)
+            return image_paths[index], failed, answer
+
+        try:
+            while next_index < len(image_paths) or in_flight:
+                # Keep up to window requests on the connection
+                while next_index < len(image_paths) and len(in_flight) < window:
+                    index = next_index
+                    next_index += 1
+                    try:
+                        if executor is None:
+                            image_data = self.prepare(image_paths[index])
+                        else:
+                            for ahead in range(index, min(len(image_paths), index + window)):
+                                if ahead not in prepared:
+                                    prepared[ahead] = executor.submit(self.prepare, image_paths[ahead])
+                            image_data = prepared.pop(index).result()
+                    except Exception as e:
+                        yield result(index, True, f"Could not read image: {e}")
+                        continue
+                    in_flight[self.send_image(image_data, question)] = index
+                    if on_sent is not None:
+                        on_sent(index, image_paths[index])
+
+                if not in_flight:
+                    continue
+
+                # Answers arrive in completion order, matched back by request id
+                request_id, failed, answer = self.receive_answer()
+                index = in_flight.pop(request_id, None)
+                if index is not None:
+                    yield result(index, failed, answer)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def iter_history(self, page_size=HISTORY_PAGE_SIZE):
+        """Yield every history entry of the logged-in user, newest first"""
+        cursor = ""
+        while True:
+            page = fetch_history_page(self.host, self.port, self.session_token, cursor, page_size)
+            yield from page["entries"]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
@@ -0,0 +1,184 @@
+"""VegSecAI wire protocol shared by the server and the client.
+
+Every message travels as one frame:
+
+    version (1 byte) | type (1 byte) | request id (4 bytes) | length (4 bytes) | payload
+
+Frames are self-delimiting, so several requests can be written back to back
+(pipelined) and replies are matched to requests by their request id.
+The same module is shipped in Server/ and Client/ because they are deployed separately.
+"""
+import asyncio
+import struct
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBII")
+MAX_FRAME_SIZE = 64 * 1024 * 1024  # 64 MB
+MAX_TEXT_SIZE = 64 * 1024  # form fields and text replies; also bounds what a peer can send before logging in
+RECV_CHUNK_SIZE = 256 * 1024  # bytes requested per recv_into call
+
+# Frame types
+FRAME_TEXT = 1   # UTF-8 text: request names, form fields and replies
+FRAME_IMAGE = 2  # Raw image bytes
+FRAME_BYE = 3    # Client is logging out
+FRAME_END = 4    # End of a multi-frame reply such as history
+FRAME_ERROR = 5  # UTF-8 error message
+FRAME_HISTORY = 6  # JSON list of history entries
+FRAME_THUMBNAIL = 7  # 64-character hex image hash followed by the thumbnail bytes
+
+# Function declarations:
+# def encode_frame(frame_type: int, payload: bytes = b'', request_id: int = 0) -> bytes
+# def decode_header(header: bytes, max_size: int = MAX_FRAME_SIZE) -> tuple[int, int, int]
+# def send_frame(sock, frame_type: int, payload: bytes = b'', request_id: int = 0) -> None
+# def send_frames(sock, frames: list[tuple[int, bytes, int]]) -> None
+# def send_text(sock, text: str, request_id: int = 0) -> None
+# def send_texts(sock, texts: list[str], request_id: int = 0) -> None
+# def recv_exactly(sock, length: int, hasher=None, preallocate: bool = True) -> bytearray
+# def recv_frame(sock, max_size: int = MAX_FRAME_SIZE, hasher=None) -> tuple[int, int, bytearray] | None
+# def recv_text(sock, max_size: int = MAX_TEXT_SIZE) -> str
+# async def read_frame(reader, max_size: int = MAX_FRAME_SIZE, hasher=None) -> tuple[int, int, bytearray] | None
+# async def read_text(reader, max_size: int = MAX_TEXT_SIZE) -> str
+# async def write_frame(writer, frame_type: int, payload: bytes = b'', request_id: int = 0) -> None
+# async def write_text(writer, text: str, request_id: int = 0) -> None
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends a malformed or unexpected frame"""
+
+
+class FrameTooLargeError(ProtocolError):
+    """Raised when a frame header announces more bytes than the receiver accepts"""
+
+
+def encode_frame(frame_type, payload=b'', request_id=0):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, request_id, len(payload)) + payload
+
+
+def decode_header(header, max_size=MAX_FRAME_SIZE):
+    """Validate a frame header and return (frame_type, request_id, length)"""
+    version, frame_type, request_id, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if length > max_size:
+        raise FrameTooLargeError(f"Frame of {length} bytes exceeds the {max_size} byte limit")
+    return frame_type, request_id, length
+
+
+def send_frame(sock, frame_type, payload=b'', request_id=0):
+    sock.sendall(encode_frame(frame_type, payload, request_id))
+
+
+def send_frames(sock, frames):
+    """Send several (frame_type, payload, request_id) frames with a single write"""
+    sock.sendall(b''.join(encode_frame(*frame) for frame in frames))
+
+
+def send_text(sock, text, request_id=0):
+    send_frame(sock, FRAME_TEXT, text.encode(), request_id)
+
+
+def send_texts(sock, texts, request_id=0):
+    """Send several text fields (e.g. a request name and its form fields) in one write"""
+    send_frames(sock, [(FRAME_TEXT, text.encode(), request_id) for text in texts])
+
+
+def recv_exactly(sock, length, hasher=None, preallocate=True):
+    """Read exactly length bytes, optionally hashing as they arrive. Without preallocate the buffer
+    grows as bytes arrive, so a large announced length costs nothing until the data is sent."""
+    if not preallocate:
+        buffer = bytearray()
+        while len(buffer) < length:
+            chunk = sock.recv(min(RECV_CHUNK_SIZE, length - len(buffer)))
+            if not chunk:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            if hasher is not None:
+                hasher.update(chunk)
+            buffer += chunk
+        return buffer
+
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    received = 0
+    while received < length:
+        count = sock.recv_into(view[received:], min(RECV_CHUNK_SIZE, length - received))
+        if count == 0:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        if hasher is not None:
+            hasher.update(view[received:received + count])
+        received += count
+    return buffer
+
+
+def recv_frame(sock, max_size=MAX_FRAME_SIZE, hasher=None):
+    """Read one frame as (frame_type, request_id, payload), or None if the peer closed cleanly"""
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    header = first
+    if len(header) < HEADER.size:
+        header += recv_exactly(sock, HEADER.size - len(header))
+    frame_type, request_id, length = decode_header(header, max_size)
+    # Only uploads, whose size the caller bounds, get a buffer of the announced length up front
+    payload = recv_exactly(sock, length, hasher, preallocate=frame_type == FRAME_IMAGE)
+    return frame_type, request_id, payload
+
+
+def recv_text(sock, max_size=MAX_TEXT_SIZE):
+    """Read a text frame and return its decoded contents"""
+    frame = recv_frame(sock, max_size)
+    if frame is None:
+        raise ConnectionError("Connection closed by peer")
+    frame_type, _, payload = frame
+    if frame_type not in (FRAME_TEXT, FRAME_ERROR):
+        raise ProtocolError(f"Expected a text frame, got type {frame_type}")
+    return payload.decode()
+
+
+async def read_frame(reader, max_size=MAX_FRAME_SIZE, hasher=None):
+    """Async counterpart of recv_frame for asyncio streams"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial == b'':
+            return None
+        raise ConnectionError("Connection closed in the middle of a frame")
+    frame_type, request_id, length = decode_header(header, max_size)
+
+    # As in recv_frame, only uploads are preallocated; other frames grow as bytes arrive
+    preallocate = frame_type == FRAME_IMAGE
+    payload = bytearray(length) if preallocate else bytearray()
+    view = memoryview(payload) if preallocate else None
+    received = 0
+    while received < length:
+        chunk = await reader.read(min(RECV_CHUNK_SIZE, length - received))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        if preallocate:
+            view[received:received + len(chunk)] = chunk
+        else:
+            payload += chunk
+        if hasher is not None:
+            hasher.update(chunk)
+        received += len(chunk)
+    return frame_type, request_id, payload
+
+
+async def read_text(reader, max_size=MAX_TEXT_SIZE):
+    frame = await read_frame(reader, max_size)
+    if frame is None:
+        raise ConnectionError("Connection closed by peer")
+    frame_type, _, payload = frame
+    if frame_type not in (FRAME_TEXT, FRAME_ERROR):
+        raise ProtocolError(f"Expected a text frame, got type {frame_type}")
+    return payload.decode()
+
+
+async def write_frame(writer, frame_type, payload=b'', request_id=0):
+    writer.write(encode_frame(frame_type, payload, request_id))
+    await writer.drain()
+
+
+async def write_text(writer, text, request_id=0):
+    await write_frame(writer, FRAME_TEXT, text.encode(), request_id)
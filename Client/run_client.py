@@ -2,15 +2,20 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from PIL import Image, ImageTk
 import os
-import socket
-import ssl
 import hashlib
 import threading
 import time
 from getpass import getpass
 import io
 import queue
+from concurrent.futures import ThreadPoolExecutor
 from camera_window import *
+from protocol import (
+    FRAME_TEXT, FRAME_IMAGE, FRAME_BYE, FRAME_ERROR,
+    recv_frame, recv_text, send_frame, send_frames, send_texts
+)
+from upload_utils import choose_upload_format, prepare_upload
+from client_api import VegSecAIClient, open_connection, fetch_upload_settings, fetch_history_page
 from functools import partial
 
 
@@ -22,6 +27,10 @@ TEXT_COLOR = "#333333"
 BUTTON_TEXT_COLOR = "#ffffff"
 FONT_FAMILY = "Helvetica"
 LOGO_PATH = "logo.png"  # Create a logo file or replace this
+HISTORY_PAGE_SIZE = 50  # History entries requested per page
+BATCH_WINDOW = 8  # Batch requests sent ahead of their answers
+BATCH_PREP_WORKERS = 2  # Threads downscaling batch images ahead of sending
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
 
 # Main class initialization
 # def __init__(self) -> None
@@ -35,8 +44,9 @@ LOGO_PATH = "logo.png"  # Create a logo file or replace this
 # def show_main_app(self) -> None
 # def show_history_view(self) -> None
 
-# Server connection function
+# Server connection functions
 # def connect_to_server(self) -> bool
+# def get_upload_settings(self) -> dict
 
 # Authentication functions
 # def process_login(self) -> None
@@ -54,9 +64,20 @@ LOGO_PATH = "logo.png"  # Create a logo file or replace this
 # Image handling functions
 # def upload_image(self) -> None
 # def display_image(self, image_path: str) -> None
+# def start_upload_preparation(self, image_path: str) -> None
+# def _prepare_upload(self, image_path: str) -> bytes
+# def get_prepared_upload(self, image_path: str) -> bytes
 # def send_image_to_server(self) -> None
 # def _send_image_to_server_thread(self, image_path: str, question: str) -> None
 
+# Batch analysis functions
+# def select_batch_files(self) -> None
+# def select_batch_folder(self) -> None
+# def start_batch(self, paths: list[str]) -> None
+# def show_batch_window(self, paths: list[str]) -> None
+# def update_batch_item(self, index: int, status: str, answer: str, done: int) -> None
+# def _run_batch_thread(self, paths: list[str], question: str) -> None
+
 # Session management
 # def logout(self) -> None
 
@@ -73,13 +94,23 @@ class VegSecAIApp(tk.Tk):
         self.client_socket = None
         self.is_logged_in = False
         self.current_user = None
+        self.session_token = None
         self.current_image = None
         self.current_image_path = None
+        self.next_request_id = 1
+        self.upload_settings = None  # Fetched from the server on first upload
+        # Downscales and re-encodes the selected image while the user types a question
+        self.preprocess_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-prep")
+        self.prepared_upload = None  # (image path, Future of the bytes to send)
+        self.batch_running = False
+        self.batch_tree = None  # Per-image rows of the batch window
 
         # Create and show the login frame
         self.show_login_frame()
 
         self.history_data = []  # Store history entries locally
+        self.history_cursor = ""  # Cursor of the next history page, empty when there is none
+        self.history_thumbnails = {}  # Server-generated thumbnail bytes by image hash
         self.history_frame = None  # Reference to history view frame
 
     def show_login_frame(self):
@@ -334,10 +365,18 @@ class VegSecAIApp(tk.Tk):
         )
         self.loading_label.pack(pady=20)
 
-        # Start background thread for fetching history
+        # Start from the newest page
+        self.history_data = []
+        self.history_cursor = ""
+        self.history_thumbnails = {}
         self.history_queue = queue.Queue()
+        self.start_history_fetch()
+
+    def start_history_fetch(self):
+        """Fetch the next history page in the background"""
         self.history_thread = threading.Thread(
             target=self.fetch_history_thread,
+            args=(self.history_cursor,),
             daemon=True
         )
         self.history_thread.start()
@@ -345,66 +384,22 @@ class VegSecAIApp(tk.Tk):
         # Start periodic check for history
         self.after(100, self.check_history_thread)
 
-    def fetch_history_thread(self):
-        """Background thread to fetch history from server"""
-        try:
-            # Establish a new socket connection
-            history_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            history_socket = ssl.wrap_socket(history_socket)
-            history_socket.connect((self.server_ip_var.get(), 12378))
-
-            # Send get_history request
-            history_socket.send("get_history".encode())
-            history_socket.send(self.current_user.encode())
-
-            # Receive history entries with proper buffering
-            history_data = []
-            buffer = ""
-            delimiter = "END_HISTORY"
-            delimiter_length = len(delimiter)
-
-            while True:
-                try:
-                    chunk = history_socket.recv(1024).decode()
-                    if not chunk:
-                        break
-
-                    buffer += chunk
-
-                    # Process all complete entries in buffer
-                    while delimiter in buffer:
-                        delimiter_pos = buffer.find(delimiter)
-                        entry = buffer[:delimiter_pos].strip()
-                        buffer = buffer[delimiter_pos + delimiter_length:]
-
-                        if entry:
-                            # Clean and validate entry
-                            cleaned_entry = entry.replace('&#124;', '|')
-                            if cleaned_entry.count('|') == 3:  # Ensure proper format
-                                history_data.append(cleaned_entry)
-                            else:
-                                print(f"Skipping malformed entry: {cleaned_entry}")
-
-                except socket.error as e:
-                    print(f"Socket error receiving history: {e}")
-                    break
-
-            # Handle any remaining data in buffer
-            if buffer.strip() and buffer.strip() != delimiter:
-                print(f"Unexpected trailing data: {buffer}")
-
-            # Put results in queue
-            self.history_queue.put(history_data if history_data else "No history found")
+    def load_more_history(self):
+        """Request the page after the entries already shown"""
+        if self.history_cursor:
+            self.start_history_fetch()
 
+    def fetch_history_thread(self, cursor=""):
+        """Background thread to fetch one history page from server"""
+        try:
+            # Fetch the page over a new connection and put it in the queue
+            self.history_queue.put(fetch_history_page(self.server_ip_var.get(), 12378,
+                                                      self.session_token, cursor, HISTORY_PAGE_SIZE))
         except Exception as e:
-            error_msg = f"Failed to fetch history: {str(e)}"
+            # check_history_thread shows messages starting with "Error" as errors
+            error_msg = f"Error fetching history: {str(e)}"
             print(error_msg)
             self.history_queue.put(error_msg)
-        finally:
-            try:
-                history_socket.close()
-            except:
-                pass
     def check_history_thread(self):
         """Check if history thread has completed"""
         try:
@@ -428,7 +423,12 @@ class VegSecAIApp(tk.Tk):
                     error_label.pack(pady=20)
                     return
 
-                # Display history entries
+                # Append the new page and display all entries
+                if isinstance(history_data, dict):
+                    self.history_data.extend(history_data["entries"])
+                    self.history_thumbnails.update(history_data["thumbnails"])
+                    self.history_cursor = history_data["next_cursor"]
+                    history_data = self.history_data if self.history_data else "No history found"
                 self.display_history_entries(history_data)
 
             except queue.Empty:
@@ -502,11 +502,14 @@ class VegSecAIApp(tk.Tk):
         for entry in history_data:
             try:
                 # Validate entry format
-                if not isinstance(entry, str) or entry.count('|') != 3:
+                if not isinstance(entry, dict):
                     print(f"Skipping malformed entry: {entry}")
                     continue
 
-                timestamp, image_hash, question, answer = entry.split('|', 3)
+                timestamp = entry.get("timestamp", "")
+                image_hash = entry.get("image_hash", "")
+                question = entry.get("question", "")
+                answer = entry.get("answer", "")
 
                 # Create entry frame
                 entry_frame = tk.Frame(scrollable_frame, bg=BACKGROUND_COLOR,
@@ -519,10 +522,9 @@ class VegSecAIApp(tk.Tk):
                 image_frame.pack(side="left", padx=10, pady=5)
 
                 try:
-                    image_path = os.path.join("images", f"{image_hash}.jpg")
-                    if os.path.exists(image_path):
-                        img = Image.open(image_path)
-                        img.thumbnail((100, 100), Image.LANCZOS)
+                    thumbnail = self.history_thumbnails.get(image_hash)
+                    if thumbnail:
+                        img = Image.open(io.BytesIO(thumbnail))
                         photo = ImageTk.PhotoImage(img)
                         img_label = tk.Label(image_frame, image=photo, bg=BACKGROUND_COLOR)
                         img_label.image = photo
@@ -580,6 +582,19 @@ class VegSecAIApp(tk.Tk):
 
             except Exception as e:
                 print(f"Error displaying history entry: {e}")
+
+        # Offer the next page if the server has more entries
+        if self.history_cursor:
+            load_more_button = tk.Button(
+                scrollable_frame,
+                text="Load More",
+                font=(FONT_FAMILY, 10),
+                bg=PRIMARY_COLOR,
+                fg=BUTTON_TEXT_COLOR,
+                padx=10,
+                command=self.load_more_history
+            )
+            load_more_button.pack(pady=10)
     def process_single_entry(self, entry, parent_frame):
         """Helper method to process individual entries"""
         entry_data = entry.split("|")
@@ -1028,6 +1043,30 @@ class VegSecAIApp(tk.Tk):
         )
         camera_button.grid(row=0, column=1, padx=10)
 
+        batch_files_button = tk.Button(
+            button_frame,
+            text="Batch Files",
+            font=(FONT_FAMILY, 12),
+            bg=PRIMARY_COLOR,
+            fg=BUTTON_TEXT_COLOR,
+            padx=20,
+            pady=5,
+            command=self.select_batch_files
+        )
+        batch_files_button.grid(row=1, column=0, padx=10, pady=(10, 0))
+
+        batch_folder_button = tk.Button(
+            button_frame,
+            text="Batch Folder",
+            font=(FONT_FAMILY, 12),
+            bg=PRIMARY_COLOR,
+            fg=BUTTON_TEXT_COLOR,
+            padx=20,
+            pady=5,
+            command=self.select_batch_folder
+        )
+        batch_folder_button.grid(row=1, column=1, padx=10, pady=(10, 0))
+
         # Question entry
         question_frame = tk.Frame(content_frame, bg=BACKGROUND_COLOR)
         question_frame.pack(pady=10, fill="x")
@@ -1095,18 +1134,18 @@ class VegSecAIApp(tk.Tk):
 
         server_ip = self.server_ip_var.get()
         try:
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((server_ip, 12378))
-            self.client_socket = context.wrap_socket(client_socket)
+            self.client_socket = open_connection(server_ip, 12378)
             return True
         except Exception as e:
             self.after(0, lambda: self.show_error(f"Failed to connect to server: {e}"))
             return False
 
+    def get_upload_settings(self):
+        """Ask the server how large uploads may be and which formats it accepts (cached)"""
+        if self.upload_settings is None:
+            self.upload_settings = fetch_upload_settings(self.server_ip_var.get(), 12378)
+        return self.upload_settings
+
     def show_error(self, message):
         """Show error message and remove loading indicator"""
         if hasattr(self, 'loading_label'):
@@ -1149,14 +1188,14 @@ class VegSecAIApp(tk.Tk):
 
         try:
             # Send login request
-            self.client_socket.send("login".encode())
-            self.client_socket.send(username.encode())
-            self.client_socket.send(password.encode())
+            send_texts(self.client_socket, ["login", username, password])
 
             # Receive response
-            response = self.client_socket.recv(1024).decode()
+            response = recv_text(self.client_socket)
 
             if response == "Login successful":
+                # Presented by side connections such as history requests
+                self.session_token = recv_text(self.client_socket)
                 self.current_user = username
                 self.is_logged_in = True
                 # Update UI from thread
@@ -1212,13 +1251,10 @@ class VegSecAIApp(tk.Tk):
 
         try:
             # Send signup request
-            self.client_socket.send("signup".encode())
-            self.client_socket.send(username.encode())
-            self.client_socket.send(password.encode())
-            self.client_socket.send(email.encode())
+            send_texts(self.client_socket, ["signup", username, password, email])
 
             # Receive response
-            response = self.client_socket.recv(1024).decode()
+            response = recv_text(self.client_socket)
 
             if response.startswith("Verification code sent"):
                 # Update UI from thread
@@ -1293,10 +1329,10 @@ class VegSecAIApp(tk.Tk):
         """Background thread for verification process"""
         try:
             # Send verification code
-            self.client_socket.send(verification_code.encode())
+            send_texts(self.client_socket, [verification_code])
 
             # Receive response
-            response = self.client_socket.recv(1024).decode()
+            response = recv_text(self.client_socket)
 
             if response == "Account created successfully":
                 # Update UI from thread
@@ -1339,11 +1375,10 @@ class VegSecAIApp(tk.Tk):
 
         try:
             # Send forgot password request
-            self.client_socket.send("forgot_password".encode())
-            self.client_socket.send(email.encode())
+            send_texts(self.client_socket, ["forgot_password", email])
 
             # Receive response
-            response = self.client_socket.recv(1024).decode()
+            response = recv_text(self.client_socket)
 
             if response.startswith("Password reset token sent"):
                 # Update UI from thread
@@ -1398,12 +1433,10 @@ class VegSecAIApp(tk.Tk):
         try:
             # We're already in the forgot_password flow on the server side
             # Send the reset information in the expected order
-            self.client_socket.send(username.encode())
-            self.client_socket.send(reset_token.encode())
-            self.client_socket.send(new_password.encode())
+            send_texts(self.client_socket, [username, reset_token, new_password])
 
             # Receive response
-            response = self.client_socket.recv(1024).decode()
+            response = recv_text(self.client_socket)
 
             if response == "Password reset successful":
                 # Update UI from thread
@@ -1472,9 +1505,25 @@ class VegSecAIApp(tk.Tk):
 
             # Set the current image path so it can be sent to server
             self.current_image_path = image_path
+            self.start_upload_preparation(image_path)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to display image: {e}")
 
+    def start_upload_preparation(self, image_path):
+        """Begin downscaling and re-encoding an image in the background"""
+        future = self.preprocess_executor.submit(self._prepare_upload, image_path)
+        self.prepared_upload = (image_path, future)
+
+    def _prepare_upload(self, image_path):
+        settings = self.get_upload_settings()
+        return prepare_upload(image_path, settings["max_edge"], choose_upload_format(settings["formats"]))
+
+    def get_prepared_upload(self, image_path):
+        """Return the bytes to upload for an image, waiting for its preprocessing if needed"""
+        if self.prepared_upload is None or self.prepared_upload[0] != image_path:
+            self.start_upload_preparation(image_path)
+        return self.prepared_upload[1].result()
+
     def send_image_to_server(self):
         """Send the current image to the server for analysis in a separate thread"""
         if not self.is_logged_in:
@@ -1485,6 +1534,10 @@ class VegSecAIApp(tk.Tk):
             messagebox.showwarning("No Image", "Please upload or take a photo first.")
             return
 
+        if self.batch_running:
+            messagebox.showwarning("Batch Running", "Please wait for the batch analysis to finish.")
+            return
+
         # Get user's question
         question = self.question_var.get()
         if not question.strip():
@@ -1501,26 +1554,35 @@ class VegSecAIApp(tk.Tk):
 
     def _send_image_to_server_thread(self, image_path, question):
         """Background thread for sending image to server"""
-        # Read the image file
+        # Downscaled, metadata-free copy of the image (usually ready by now)
         try:
-            with open(image_path, "rb") as img_file:
-                image_data = img_file.read()
+            image_data = self.get_prepared_upload(image_path)
 
-            # Calculate image hash
+            # Hash exactly the bytes that are sent
             image_hash = hashlib.sha256(image_data).hexdigest()
 
-            # Send to server
+            # Send the image, its hash and the question as one tagged request
             try:
-                self.client_socket.send(len(image_data).to_bytes(4, "big"))
-                self.client_socket.send(image_data)
-                self.client_socket.send(image_hash.encode())
-                self.client_socket.send(question.encode())
+                request_id = self.next_request_id
+                self.next_request_id += 1
+                send_frames(self.client_socket, [
+                    (FRAME_IMAGE, image_data, request_id),
+                    (FRAME_TEXT, image_hash.encode(), request_id),
+                    (FRAME_TEXT, question.encode(), request_id),
+                ])
 
                 # Receive response
-                answer = self.client_socket.recv(1024).decode()
+                frame = recv_frame(self.client_socket)
+                if frame is None:
+                    raise ConnectionError("Server closed the connection")
+                frame_type, _, payload = frame
+                answer = payload.decode()
 
                 # Update UI from thread
-                if answer == "Image hash mismatch.":
+                if frame_type == FRAME_ERROR:
+                    # e.g. the model is still warming up; the session stays usable
+                    self.after(0, lambda: messagebox.showerror("Error", answer))
+                elif answer == "Image hash mismatch.":
                     self.after(0, lambda: messagebox.showerror("Error",
                                                                "Image verification failed. Please try uploading again."))
                 elif answer.startswith("Invalid image format"):
@@ -1536,11 +1598,132 @@ class VegSecAIApp(tk.Tk):
             # Update UI from thread
             self.after(0, lambda: messagebox.showerror("Error", f"Failed to process image: {e}"))
 
+    def select_batch_files(self):
+        """Pick several images to analyze as one batch"""
+        paths = filedialog.askopenfilenames(
+            title="Select images",
+            filetypes=(("Image files", "*.jpg *.jpeg *.png *.webp"), ("All files", "*.*"))
+        )
+        if paths:
+            self.start_batch(list(paths))
+
+    def select_batch_folder(self):
+        """Analyze every image in a folder as one batch"""
+        folder = filedialog.askdirectory(title="Select a folder of images")
+        if not folder:
+            return
+        paths = [
+            os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(folder, name))
+        ]
+        if not paths:
+            messagebox.showwarning("No Images", "The selected folder contains no JPEG, PNG or WebP images.")
+            return
+        self.start_batch(paths)
+
+    def start_batch(self, paths):
+        """Send a batch of images over the logged-in connection in a background thread"""
+        if not self.is_logged_in:
+            messagebox.showwarning("Not Logged In", "You need to be logged in to use this feature.")
+            return
+        if self.batch_running:
+            messagebox.showwarning("Batch Running", "A batch analysis is already in progress.")
+            return
+
+        question = self.question_var.get()
+        if not question.strip():
+            question = "What vegetable is this?"
+
+        self.show_batch_window(paths)
+        self.batch_running = True
+        batch_thread = threading.Thread(target=self._run_batch_thread, args=(paths, question))
+        batch_thread.daemon = True
+        batch_thread.start()
+
+    def show_batch_window(self, paths):
+        """Open a window listing every image in the batch with its status and answer"""
+        window = tk.Toplevel(self)
+        window.title("Batch Analysis")
+        window.geometry("760x420")
+        window.configure(bg=BACKGROUND_COLOR)
+
+        self.batch_status_var = tk.StringVar(value=f"0 / {len(paths)} images analyzed")
+        status_label = tk.Label(
+            window,
+            textvariable=self.batch_status_var,
+            font=(FONT_FAMILY, 12),
+            bg=BACKGROUND_COLOR,
+            fg=TEXT_COLOR
+        )
+        status_label.pack(pady=(10, 5))
+
+        self.batch_progress = ttk.Progressbar(window, maximum=len(paths), mode="determinate")
+        self.batch_progress.pack(fill="x", padx=20, pady=5)
+
+        tree_frame = tk.Frame(window, bg=BACKGROUND_COLOR)
+        tree_frame.pack(fill="both", expand=True, padx=20, pady=10)
+
+        tree = ttk.Treeview(tree_frame, columns=("file", "status", "answer"), show="headings")
+        tree.heading("file", text="File")
+        tree.heading("status", text="Status")
+        tree.heading("answer", text="Answer")
+        tree.column("file", width=180)
+        tree.column("status", width=80)
+        tree.column("answer", width=440)
+        scrollbar = ttk.Scrollbar(tree_frame, orient="vertical", command=tree.yview)
+        tree.configure(yscrollcommand=scrollbar.set)
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+        for index, path in enumerate(paths):
+            tree.insert("", "end", iid=str(index), values=(os.path.basename(path), "Queued", ""))
+        self.batch_tree = tree
+        self.batch_total = len(paths)
+
+    def update_batch_item(self, index, status, answer, done):
+        """Show the progress of one batch image (runs on the UI thread)"""
+        if self.batch_tree is None or not self.batch_tree.winfo_exists():
+            return
+        self.batch_tree.set(str(index), "status", status)
+        self.batch_tree.set(str(index), "answer", answer)
+        self.batch_progress["value"] = done
+        self.batch_status_var.set(f"{done} / {self.batch_total} images analyzed")
+
+    def _run_batch_thread(self, paths, question):
+        """Background thread that pipelines a batch and records answers as they arrive"""
+        # The batch runs on the logged-in connection through the headless client's pipeline
+        client = VegSecAIClient.from_socket(self.client_socket, self.server_ip_var.get(), 12378,
+                                            self.current_user, self.session_token)
+        client.upload_settings = self.get_upload_settings()
+        client.next_request_id = self.next_request_id
+        done = 0
+
+        def on_sent(index, path):
+            self.after(0, partial(self.update_batch_item, index, "Sent", "", done))
+
+        def on_result(index, path, failed, answer):
+            nonlocal done
+            done += 1
+            self.after(0, partial(self.update_batch_item, index, "Failed" if failed else "Done", answer, done))
+
+        try:
+            for _ in client.analyze_many(paths, question, BATCH_WINDOW, BATCH_PREP_WORKERS, on_sent, on_result):
+                pass
+        except Exception as e:
+            if self.is_logged_in:
+                error_message = str(e)
+                self.after(0, lambda msg=error_message: messagebox.showerror(
+                    "Connection Error", f"Batch analysis stopped: {msg}"))
+                self.after(0, self.logout)
+        finally:
+            self.next_request_id = client.next_request_id
+            self.batch_running = False
+
     def logout(self):
         """Log the user out and return to login screen"""
         if self.client_socket:
             try:
-                self.client_socket.send("#bye".encode())
+                send_frame(self.client_socket, FRAME_BYE)
                 self.client_socket.close()
             except:
                 pass
@@ -1548,6 +1731,7 @@ class VegSecAIApp(tk.Tk):
 
         self.is_logged_in = False
         self.current_user = None
+        self.session_token = None
         self.current_image = None
         self.current_image_path = None
         self.show_login_frame()
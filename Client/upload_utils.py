@@ -0,0 +1,36 @@
+import io
+import os
+from PIL import Image, ImageOps, features
+
+# Upload preprocessing defaults; the server's upload_settings reply overrides the size limit
+DEFAULT_MAX_EDGE = 1024
+UPLOAD_QUALITY = int(os.getenv("VEGSECAI_UPLOAD_QUALITY", 85))
+UPLOAD_FORMAT = os.getenv("VEGSECAI_UPLOAD_FORMAT", "webp" if features.check('webp') else "jpeg").lower()
+
+# Function declarations:
+# def choose_upload_format(server_formats: list[str]) -> str
+# def prepare_upload(image_path: str, max_edge: int = DEFAULT_MAX_EDGE, image_format: str = UPLOAD_FORMAT, quality: int = UPLOAD_QUALITY) -> bytes
+
+
+def choose_upload_format(server_formats):
+    """Use the preferred upload format if the server accepts it, otherwise JPEG"""
+    if UPLOAD_FORMAT in server_formats and (UPLOAD_FORMAT != "webp" or features.check('webp')):
+        return UPLOAD_FORMAT
+    return "jpeg"
+
+
+def prepare_upload(image_path, max_edge=DEFAULT_MAX_EDGE, image_format=UPLOAD_FORMAT, quality=UPLOAD_QUALITY):
+    """Downscale an image to max_edge and re-encode it, dropping EXIF and other metadata"""
+    with Image.open(image_path) as image:
+        # Lets the JPEG decoder scale down while decoding instead of decoding full size first
+        image.draft('RGB', (max_edge, max_edge))
+        # Apply the camera's orientation tag before the metadata is discarded
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    # Saving without exif/icc_profile arguments writes none of the original metadata
+    output = io.BytesIO()
+    image.save(output, format=image_format.upper(), quality=quality)
+    return output.getvalue()
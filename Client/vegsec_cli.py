@@ -0,0 +1,187 @@
+"""Command-line VegSecAI client for scripted and bulk analysis.
+
+Examples:
+    python vegsec_cli.py --server 192.168.1.10 -u alice analyze crate_17/ --output results.csv
+    python vegsec_cli.py --server 192.168.1.10 -u alice history --output history.json
+
+The password is read from VEGSECAI_PASSWORD, or prompted for when it is not set.
+
+Exit codes: 0 success, 1 some images could not be analyzed, 2 invalid arguments,
+3 login rejected, 4 connection or protocol error.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from getpass import getpass
+from client_api import (
+    VegSecAIClient, LoginError, SERVER_PORT, DEFAULT_QUESTION, PIPELINE_WINDOW, UPLOAD_SETTINGS_TIMEOUT,
+    fetch_upload_settings
+)
+
+EXIT_OK = 0
+EXIT_FAILED_IMAGES = 1
+EXIT_USAGE = 2
+EXIT_LOGIN = 3
+EXIT_CONNECTION = 4
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+# The threaded server handles MAX_THREADS (default 5) connections at once; a session holds one
+# for its whole length, so stay below that and leave a slot for other clients
+MAX_CONNECTIONS = 4
+
+# Function declarations:
+# def collect_images(paths: list[str], recursive: bool) -> list[str]
+# def write_records(records: list[dict], output: str, fields: list[str]) -> None
+# def run_analyze(args) -> int
+# def run_history(args) -> int
+# def main(argv: list[str] | None = None) -> int
+
+
+def collect_images(paths, recursive):
+    """Expand files and directories into a sorted list of image files"""
+    images = []
+    for path in paths:
+        if os.path.isdir(path):
+            if recursive:
+                for root, _, names in os.walk(path):
+                    images.extend(os.path.join(root, name) for name in names)
+            else:
+                images.extend(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            images.append(path)
+    return sorted(p for p in images if p.lower().endswith(IMAGE_EXTENSIONS) or p in paths)
+
+
+def write_records(records, output, fields):
+    """Write records as JSON or CSV (chosen by the file extension) to a file, or JSON to stdout for '-'"""
+    if output.lower().endswith('.csv'):
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(records)
+    elif output == '-':
+        json.dump(records, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(records, f, indent=2)
+
+
+def _login(args):
+    client = VegSecAIClient(args.server, args.port, args.timeout)
+    client.login(args.username, args.password)
+    return client
+
+
+def run_analyze(args):
+    images = collect_images(args.paths, args.recursive)
+    if not images:
+        print("No images to analyze.", file=sys.stderr)
+        return EXIT_USAGE
+
+    # Fetched before logging in: once the sessions are open they may hold every server slot
+    upload_settings = fetch_upload_settings(args.server, args.port, args.timeout or UPLOAD_SETTINGS_TIMEOUT)
+
+    # Logins run one after another: concurrent attempts count against the server's rate limit
+    connections = max(1, min(args.connections, len(images)))
+    clients = []
+    try:
+        for _ in range(connections):
+            clients.append(_login(args))
+    except Exception:
+        for client in clients:
+            client.close()
+        raise
+    for client in clients:
+        client.upload_settings = upload_settings
+
+    records = []
+    records_lock = threading.Lock()
+    started = time.time()
+
+    def run_session(client, session_images):
+        with client:
+            for image_path, failed, answer in client.analyze_many(session_images, args.question, args.window):
+                record = {"path": image_path, "status": "failed" if failed else "ok", "answer": answer}
+                with records_lock:
+                    records.append(record)
+                    if not args.quiet:
+                        print(f"[{len(records)}/{len(images)}] {image_path}: {answer}", flush=True)
+
+    # Deal the images round-robin so every connection gets a similar share
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        sessions = [executor.submit(run_session, client, images[i::connections])
+                    for i, client in enumerate(clients)]
+        for session in sessions:
+            session.result()
+
+    failed = sum(record["status"] == "failed" for record in records)
+    elapsed = time.time() - started
+    print(f"Analyzed {len(records) - failed}/{len(images)} images in {elapsed:.1f} s "
+          f"({len(records) / elapsed if elapsed else 0:.1f} images/s), {failed} failed.", file=sys.stderr)
+
+    if args.output:
+        records.sort(key=lambda record: record["path"])
+        write_records(records, args.output, ["path", "status", "answer"])
+    return EXIT_FAILED_IMAGES if failed else EXIT_OK
+
+
+def run_history(args):
+    with _login(args) as client:
+        entries = list(client.iter_history(args.page_size))
+    write_records(entries, args.output, ["timestamp", "image_hash", "question", "answer"])
+    print(f"Exported {len(entries)} history entries.", file=sys.stderr)
+    return EXIT_OK
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless VegSecAI client")
+    parser.add_argument("--server", required=True, help="server address")
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("-u", "--username", required=True)
+    parser.add_argument("--timeout", type=float, default=None, help="socket timeout in seconds")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze_parser = subparsers.add_parser("analyze", help="analyze image files or directories")
+    analyze_parser.add_argument("paths", nargs="+")
+    analyze_parser.add_argument("-q", "--question", default=DEFAULT_QUESTION)
+    analyze_parser.add_argument("-r", "--recursive", action="store_true", help="descend into subdirectories")
+    analyze_parser.add_argument("--window", type=int, default=PIPELINE_WINDOW,
+                                help="requests in flight per connection")
+    analyze_parser.add_argument("--connections", type=int, default=1,
+                                help=f"parallel logged-in sessions, at most {MAX_CONNECTIONS}")
+    analyze_parser.add_argument("-o", "--output", help="write results to a .json or .csv file ('-' for stdout)")
+    analyze_parser.add_argument("--quiet", action="store_true", help="do not print each answer")
+
+    history_parser = subparsers.add_parser("history", help="export analysis history")
+    history_parser.add_argument("-o", "--output", default="-", help=".json or .csv file, or '-' for stdout")
+    history_parser.add_argument("--page-size", type=int, default=200)
+
+    args = parser.parse_args(argv)
+    if args.command == "analyze" and not 1 <= args.connections <= MAX_CONNECTIONS:
+        parser.error(f"--connections must be between 1 and {MAX_CONNECTIONS}")
+    args.password = os.getenv("VEGSECAI_PASSWORD") or getpass("Password: ")
+
+    try:
+        if args.command == "analyze":
+            return run_analyze(args)
+        return run_history(args)
+    except LoginError as e:
+        print(f"Login failed: {e}", file=sys.stderr)
+        return EXIT_LOGIN
+    except (OSError, ConnectionError) as e:
+        print(f"Connection error: {e}", file=sys.stderr)
+        return EXIT_CONNECTION
+    except Exception as e:
+        # Malformed frames and other protocol failures
+        print(f"Error: {e}", file=sys.stderr)
+        return EXIT_CONNECTION
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""Check that a reduced-precision inference mode still answers a fixed vegetable set correctly.
+
+The set lives in ACCURACY_SET_DIR (default: accuracy_set/) as images plus a manifest.json:
+
+    [
+        {"image": "carrot_01.jpg", "question": "What vegetable is this?", "expected": ["carrot"]},
+        ...
+    ]
+
+An answer counts as correct when it contains any of the expected keywords (case-insensitive).
+The candidate precision is compared against an fp32 reference run; the script exits with
+status 1 if the candidate's accuracy drops more than --tolerance below the reference.
+
+Usage: python accuracy_check.py --precision int8 [--reference fp32] [--tolerance 0.0]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from dotenv import load_dotenv
+from PIL import Image
+from stats_utils import peak_rss_mb
+
+load_dotenv()
+
+ACCURACY_SET_DIR = os.getenv("ACCURACY_SET_DIR", "accuracy_set")
+
+# Function declarations:
+# def load_accuracy_set(set_dir: str) -> list[dict]
+# def run_accuracy_set(samples: list[dict], precision_mode: str) -> dict
+# def main() -> int
+
+
+def load_accuracy_set(set_dir):
+    manifest_path = os.path.join(set_dir, "manifest.json")
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"No accuracy set manifest at {manifest_path}")
+    with open(manifest_path) as f:
+        samples = json.load(f)
+    for sample in samples:
+        sample["path"] = os.path.join(set_dir, sample["image"])
+    return samples
+
+
+def run_accuracy_set(samples, precision_mode):
+    """Load the model in the given precision and answer every sample"""
+    import vegsecai_model
+
+    load_started = time.time()
+    vegsecai_model.load_model(precision_mode)
+    load_seconds = time.time() - load_started
+
+    answers = []
+    correct = 0
+    latencies = []
+    for sample in samples:
+        image = Image.open(sample["path"])
+        started = time.time()
+        # No image hash: every run encodes its images, so latency includes the encoder
+        answer = vegsecai_model.query_ai(image, sample["question"])
+        latencies.append(time.time() - started)
+
+        is_correct = any(keyword.lower() in answer.lower() for keyword in sample["expected"])
+        correct += is_correct
+        answers.append({"image": sample["image"], "answer": answer, "correct": is_correct})
+
+    return {
+        "precision": vegsecai_model.precision,
+        "accuracy": correct / len(samples) if samples else 0.0,
+        "load_seconds": load_seconds,
+        "mean_latency_seconds": sum(latencies) / len(latencies) if latencies else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "answers": answers,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare answer accuracy across inference precisions")
+    parser.add_argument("--precision", default=os.getenv("INFERENCE_PRECISION", "int8"))
+    parser.add_argument("--reference", default="fp32")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+                        help="allowed accuracy drop versus the reference (0.05 = five points)")
+    parser.add_argument("--set-dir", default=ACCURACY_SET_DIR)
+    parser.add_argument("--output", help="write the full JSON report to this file")
+    args = parser.parse_args()
+
+    samples = load_accuracy_set(args.set_dir)
+    # Candidate first so its peak RSS is not inflated by the larger reference model
+    candidate = run_accuracy_set(samples, args.precision)
+    reference = run_accuracy_set(samples, args.reference)
+
+    agreement = sum(
+        a["correct"] == b["correct"] for a, b in zip(candidate["answers"], reference["answers"])
+    ) / len(samples) if samples else 0.0
+    report = {"candidate": candidate, "reference": reference, "agreement": agreement}
+
+    for run in (reference, candidate):
+        print(f"[Accuracy] {run['precision']:>7}: accuracy {run['accuracy']:.1%}, "
+              f"{run['mean_latency_seconds'] * 1000:.0f} ms/request, load {run['load_seconds']:.1f} s")
+    print(f"[Accuracy] Correctness agreement with reference: {agreement:.1%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if candidate["accuracy"] + args.tolerance < reference["accuracy"]:
+        print("[Accuracy] Regression: candidate precision is less accurate than the reference.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+import asyncio
+import contextvars
+import hashlib
+import json
+import os
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from dotenv import load_dotenv
+from generate_cert import create_server_ssl_context
+from auth_utils import (
+    login, forgot_password, reset_password, start_signup, complete_signup,
+    process_image, encode_history_page, parse_page_size, create_session, session_username, end_session,
+    MAX_UPLOAD_SIZE, MAX_PIPELINED_REQUESTS, NOT_LOGGED_IN, REQUEST_TYPES
+)
+from db_utils import init_db, flush_image_cache
+from image_utils import flush_persisted_images, start_blob_gc, upload_settings
+from inference_scheduler import ModelNotReadyError, start_model_loading, stop_model
+from metrics_utils import ACTIVE_HANDLERS, BYTES_RECEIVED, CONNECTIONS_TOTAL, REQUESTS_TOTAL, start_metrics_server
+from profiler_utils import start_profile
+from retention_utils import start_retention
+from trace_utils import Trace, activate, log_event, span
+from protocol import (
+    FRAME_TEXT, FRAME_IMAGE, FRAME_BYE, FRAME_ERROR, ProtocolError,
+    encode_frame, read_frame, read_text, write_frame, write_text
+)
+
+load_dotenv()
+
+# Executor sizes for blocking work offloaded from the event loop
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", 8))  # bcrypt, SQLite, email
+INFERENCE_WORKERS = int(os.getenv("ASYNC_INFERENCE_WORKERS", 5))  # image requests in flight
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+# Handler task of each open connection, keyed by its writer; dropped on shutdown
+client_connections = {}
+
+# Function declarations:
+# async def run_blocking(executor, func, *args) -> object
+# async def handle_image_loop(reader, writer, username: str, connection_id: str | None = None) -> None
+# async def handle_client_async(reader, writer) -> None
+# async def serve(host: str, port: int) -> None
+# def start_async_server(host: str, port: int) -> None
+
+
+async def run_blocking(executor, func, *args):
+    """Run a blocking call in an executor without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    # Executor threads do not inherit context variables; copy them so the call stays in its trace
+    return await loop.run_in_executor(executor, partial(contextvars.copy_context().run, func, *args))
+
+
+async def handle_image_loop(reader, writer, username, connection_id=None):
+    """Serve pipelined image questions for a logged-in session until the client says goodbye.
+
+    Up to MAX_PIPELINED_REQUESTS run at once; each answer is written as soon as it is ready,
+    tagged with its request id. A request's trace starts once it has been read: the stream
+    reader cannot tell when the next upload begins to arrive.
+    """
+    in_flight = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+    write_lock = asyncio.Lock()
+    tasks = set()
+
+    async def answer_request(trace, request_id, image_data, image_hash, question, calculated_hash):
+        # Each task has its own copy of the context, so this only affects the one request
+        with activate(trace):
+            try:
+                try:
+                    answer = await run_blocking(inference_executor, process_image,
+                                                username, image_data, image_hash, question, calculated_hash)
+                    frame_type, payload = FRAME_TEXT, answer.encode()
+                except ModelNotReadyError as e:
+                    # Sent as an error so clients do not mistake it for an answer and can retry later
+                    log_event("model_not_ready", level="warning", error=str(e))
+                    frame_type, payload = FRAME_ERROR, str(e).encode()
+                except Exception as e:
+                    log_event("image_request_failed", level="error", error=str(e))
+                    frame_type, payload = FRAME_ERROR, f"Error: {str(e)}".encode()
+                async with write_lock:
+                    with span("send"):
+                        await write_frame(writer, frame_type, payload, request_id)
+                trace.finish(outcome="error" if frame_type == FRAME_ERROR else "ok")
+            finally:
+                in_flight.release()
+
+    while True:
+        request_id = 0
+        try:
+            # Stop reading new requests until one finishes
+            await in_flight.acquire()
+            hasher = hashlib.sha256()
+            frame = await read_frame(reader, MAX_UPLOAD_SIZE, hasher)
+            if frame is None:
+                in_flight.release()
+                break
+
+            frame_type, request_id, image_data = frame
+            if frame_type == FRAME_BYE:
+                in_flight.release()
+                log_event("logged_out", username=username)
+                break
+
+            if frame_type != FRAME_IMAGE:
+                raise ProtocolError(f"Unexpected frame type {frame_type}")
+            BYTES_RECEIVED.inc(len(image_data))
+
+            image_hash = (await read_text(reader)).strip()
+            question = (await read_text(reader)).strip()
+        except Exception as e:
+            in_flight.release()
+            log_event("image_request_failed", level="error", error=str(e))
+            async with write_lock:
+                await write_frame(writer, FRAME_ERROR, f"Error: {str(e)}".encode(), request_id)
+            break
+
+        trace = Trace("image", username=username, connection_id=connection_id, request_id=request_id,
+                      bytes=len(image_data))
+        task = asyncio.create_task(answer_request(trace, request_id, image_data, image_hash, question,
+                                                  hasher.hexdigest()))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # Answer the requests that were already read before the session ended
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def handle_client_async(reader, writer):
+    client_address = writer.get_extra_info('peername')
+    trace = Trace("connection", client=f"{client_address[0]}:{client_address[1]}")
+    client_connections[writer] = asyncio.current_task()
+    try:
+        with activate(trace):
+            await _handle_connection_async(reader, writer, trace)
+    finally:
+        client_connections.pop(writer, None)
+
+
+async def _handle_connection_async(reader, writer, trace):
+    # Traces end at the first reply, as in auth_utils.handle_client
+    client_address = writer.get_extra_info('peername')
+    request_type = None
+    CONNECTIONS_TOTAL.inc()
+    ACTIVE_HANDLERS.inc()
+    try:
+        log_event("connection_established", client=trace.fields["client"])
+        with span("receive"):
+            request_type = (await read_text(reader)).strip()
+        REQUESTS_TOTAL.inc(type=request_type if request_type in REQUEST_TYPES else "invalid")
+
+        if request_type == "signup":
+            # Receive signup details
+            with span("receive"):
+                username = (await read_text(reader)).strip()
+                password = (await read_text(reader)).strip()
+                email = (await read_text(reader)).strip()
+
+            success, message = await run_blocking(blocking_executor, start_signup, username, email)
+            with span("send"):
+                await write_text(writer, message)
+            trace.finish(request_type=request_type, username=username)
+            if not success:
+                return
+
+            # Wait for the client's verification code
+            client_verification = (await read_text(reader)).strip()
+            message = await run_blocking(blocking_executor, complete_signup,
+                                         username, password, email, client_verification)
+            await write_text(writer, message)
+
+        elif request_type == "login":
+            with span("receive"):
+                username = (await read_text(reader)).strip()
+                password = (await read_text(reader)).strip()
+
+            with span("login"):
+                success, message = await run_blocking(blocking_executor, login, username, password,
+                                                      client_address[0])
+            if not success:
+                with span("send"):
+                    await write_text(writer, message)
+                trace.finish(request_type=request_type, username=username, outcome="rejected")
+                return
+
+            # The session token follows the reply; it is valid while this connection is open
+            token = create_session(username)
+            with span("send"):
+                writer.write(encode_frame(FRAME_TEXT, message.encode()) + encode_frame(FRAME_TEXT, token.encode()))
+                await writer.drain()
+            trace.finish(request_type=request_type, username=username, outcome="ok")
+            try:
+                await handle_image_loop(reader, writer, username, trace.id)
+            finally:
+                end_session(token)
+
+        elif request_type == "forgot_password":
+            with span("receive"):
+                email = (await read_text(reader)).strip()
+            with span("forgot_password"):
+                success, message = await run_blocking(blocking_executor, forgot_password, email)
+            with span("send"):
+                await write_text(writer, message)
+            trace.finish(request_type=request_type)
+
+            if success:
+                # Wait for user to enter reset information
+                username = (await read_text(reader)).strip()
+                reset_token = (await read_text(reader)).strip()
+                new_password = (await read_text(reader)).strip()
+
+                _, reset_message = await run_blocking(blocking_executor, reset_password,
+                                                      username, reset_token, new_password)
+                await write_text(writer, reset_message)
+
+        elif request_type == "get_history":
+            with span("receive"):
+                token = (await read_text(reader)).strip()
+                cursor = (await read_text(reader)).strip()
+                page_size = parse_page_size(await read_text(reader))
+
+            # Only the logged-in user may read their history
+            username = session_username(token)
+            if username is None:
+                await write_frame(writer, FRAME_ERROR, NOT_LOGGED_IN.encode())
+                trace.fields["outcome"] = "rejected"
+                return
+
+            # Stream the page as batched frames followed by an end marker
+            try:
+                with span("history_query"):
+                    frames = await run_blocking(blocking_executor, encode_history_page, username, cursor, page_size)
+            except ProtocolError as e:
+                # A bad cursor; without a reply the client would take the closed connection for the last page
+                await write_frame(writer, FRAME_ERROR, str(e).encode())
+                trace.fields["outcome"] = "rejected"
+                return
+            with span("send"):
+                for frame in frames:
+                    writer.write(frame)
+                    await writer.drain()
+            trace.fields["username"] = username
+
+        elif request_type == "upload_settings":
+            await write_text(writer, json.dumps(upload_settings()))
+
+        else:
+            await write_text(writer, "Invalid request type")
+
+    except Exception as e:
+        log_event("connection_error", level="error", error=str(e))
+        trace.fields["outcome"] = "error"
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+        ACTIVE_HANDLERS.dec()
+        trace.finish(request_type=request_type)
+        log_event("connection_closed", client=trace.fields["client"])
+
+
+async def serve(host, port):
+    context = create_server_ssl_context()
+    server = await asyncio.start_server(handle_client_async, host, port, ssl=context)
+
+    # Stop serving on SIGINT/SIGTERM where the event loop supports signal handlers
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    # SIGUSR1 captures a sampling profile of the live server
+    try:
+        loop.add_signal_handler(signal.SIGUSR1, start_profile)
+    except (AttributeError, NotImplementedError, RuntimeError):
+        pass
+
+    print(f"[Server] Listening on {host}:{port} with SSL (asyncio mode)...")
+    start_metrics_server()
+    start_blob_gc()
+    start_retention()
+
+    # Serve logins and history right away while the model loads
+    start_model_loading()
+    async with server:
+        await stop_event.wait()
+        print("\n[Server] Shutting down gracefully...")
+        # Leaving the block waits for every connection to close (Python 3.12+), so drop them first.
+        # abort skips the TLS close handshake, which an idle client would never answer.
+        server.close()
+        for writer in list(client_connections):
+            writer.transport.abort()
+        await asyncio.gather(*client_connections.values(), return_exceptions=True)
+
+
+def start_async_server(host, port):
+    init_db()
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        print("\n[Server] Shutting down gracefully...")
+    finally:
+        blocking_executor.shutdown(wait=False)
+        inference_executor.shutdown(wait=False)
+        flush_persisted_images()
+        flush_image_cache()
+        stop_model()
+        print("[Server] Server shutdown complete.")
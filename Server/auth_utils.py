@@ -1,34 +1,78 @@
 import time
+import json
 import bcrypt
 import hashlib
 import os
-import sqlite3
-import imghdr
+import queue
+import secrets
+import select
+from concurrent.futures import ThreadPoolExecutor
 from db_utils import (
-    DATABASE, username_exists, email_exists, save_user, get_user_by_username,
+    get_connection, username_exists, email_exists, save_user, get_user_by_username,
     get_user_by_email, get_verification_code, mark_account_verified,
     delete_verification_code, save_reset_token, get_reset_token,
-    update_password, save_image_cache
+    update_password, queue_image_cache
 )
 from email_utils import (
     is_valid_email, send_verification_email, generate_verification_code,
     generate_reset_token, send_password_reset_email
 )
-from vegsecai_model import query_ai as model_query_ai
+from cache_utils import (
+    get_cached_answer, store_answer, get_near_duplicate_answer, index_phash, NEAR_DUPLICATE_CACHE
+)
+from image_utils import (
+    IMAGE_TYPES, blob_path, detect_image_type, decode_image, perceptual_hash, persist_image, persist_thumbnail,
+    load_thumbnail, upload_settings
+)
+from inference_scheduler import query_ai as model_query_ai, ModelNotReadyError
+from metrics_utils import (
+    ACTIVE_HANDLERS, BYTES_RECEIVED, CACHE_LOOKUPS, IMAGE_DECODE_SECONDS, INFERENCE_SECONDS,
+    REQUESTS_TOTAL, SEMAPHORE_WAIT_SECONDS, WAITING_HANDLERS
+)
+from trace_utils import Trace, activate, call_in_trace, log_event, span
+from protocol import (
+    FRAME_TEXT, FRAME_IMAGE, FRAME_BYE, FRAME_END, FRAME_ERROR, FRAME_HISTORY, FRAME_THUMBNAIL, ProtocolError,
+    encode_frame, recv_frame, recv_text, send_frame, send_text, send_texts
+)
 
 # Rate limiting data structures
 login_attempts = {}
 MAX_ATTEMPTS = 5
 LOCKOUT_TIME = 15 * 60  # 15 minutes in seconds
-IMAGE_DIR = 'images'
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 20 * 1024 * 1024))  # 20 MB
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+HISTORY_ROWS_PER_FRAME = 25
+# Pipelined image requests answered concurrently per session, so the scheduler can batch them
+MAX_PIPELINED_REQUESTS = int(os.getenv("MAX_PIPELINED_REQUESTS", 8))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 16))  # process_image calls across all sessions
+REPLY_POLL_INTERVAL = 0.005  # seconds between reply checks while answers are pending
+REQUEST_TYPES = ("signup", "login", "forgot_password", "get_history", "upload_settings")
+NOT_LOGGED_IN = "Not logged in. Please log in again."
+
+# Sessions: token -> (username, expiry). A token is sent after a successful login and revoked
+# when that login connection ends; side connections such as history requests present it
+sessions = {}
+SESSION_TTL = int(os.getenv("SESSION_TTL", 12 * 60 * 60))  # 12 hours in seconds
+
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
 
 # Function declarations
 # def check_rate_limit(username: str, ip_address: str) -> tuple[bool, str]: ...
 # def login(username: str, password: str, ip_address: str) -> tuple[bool, str]: ...
+# def create_session(username: str) -> str: ...
+# def session_username(token: str) -> str | None: ...
+# def end_session(token: str) -> None: ...
 # def verify_account(email: str, verification_code: str) -> tuple[bool, str]: ...
 # def forgot_password(email: str) -> tuple[bool, str]: ...
 # def reset_password(username: str, reset_token: str, new_password: str) -> tuple[bool, str]: ...
-# def is_valid_image(image_data: bytes) -> bool: ...
+# def start_signup(username: str, email: str) -> tuple[bool, str]: ...
+# def complete_signup(username: str, password: str, email: str, verification_code: str) -> str: ...
+# def process_image(username: str, image_data: bytes, image_hash: str, question: str, calculated_hash: str | None = None) -> str: ...
+# def parse_page_size(page_size: str) -> int: ...
+# def get_user_history(username: str, cursor: str = "", page_size: int = HISTORY_PAGE_SIZE) -> tuple[list, str]: ...
+# def encode_history_page(username: str, cursor: str, page_size: int) -> list[bytes]: ...
+# def serve_image_requests(client_socket, username: str, connection_id: str | None = None) -> None: ...
 # def handle_client(client_socket, client_address, semaphore): ...
 
 def check_rate_limit(username, ip_address):
@@ -73,7 +117,7 @@ def login(username, password, ip_address):
     user_data = get_user_by_username(username)
 
     if not user_data:
-        print(f"[Server] Login failed for username: {username} - User not found")
+        log_event("login_failed", level="warning", username=username, reason="user not found")
         return False, "Login failed"
 
     password_hash, verified, _ = user_data
@@ -83,18 +127,43 @@ def login(username, password, ip_address):
         return False, "Account not verified. Please check your email for verification code."
 
     # Verify password using bcrypt
-    if bcrypt.checkpw(password.encode(), password_hash.encode()):
-        print(f"[Server] Login successful for username: {username}")
+    with span("bcrypt_verify"):
+        password_matches = bcrypt.checkpw(password.encode(), password_hash.encode())
+    if password_matches:
+        log_event("login_succeeded", username=username)
         # Reset failed attempts on successful login
         key = f"{username}:{ip_address}"
         if key in login_attempts:
             login_attempts[key] = (0, 0)
         return True, "Login successful"
     else:
-        print(f"[Server] Login failed for username: {username} - Password mismatch")
+        log_event("login_failed", level="warning", username=username, reason="password mismatch")
         return False, "Login failed"
 
 
+def create_session(username):
+    """Issue a session token for a user who just logged in"""
+    token = secrets.token_urlsafe(32)
+    sessions[token] = (username, time.time() + SESSION_TTL)
+    return token
+
+
+def session_username(token):
+    """Return the user a session token belongs to, or None if it is unknown or expired"""
+    session = sessions.get(token)
+    if session is None:
+        return None
+    username, expiry = session
+    if time.time() > expiry:
+        sessions.pop(token, None)
+        return None
+    return username
+
+
+def end_session(token):
+    sessions.pop(token, None)
+
+
 def verify_account(email, verification_code):
     """Verify an account using the provided verification code"""
     # Get the stored verification code
@@ -168,220 +237,412 @@ def reset_password(username, reset_token, new_password):
     return True, "Password successfully reset"
 
 
-def is_valid_image(image_data):
-    """Validate that the uploaded file is a valid image (JPEG or PNG)"""
-    # Save to a temporary file for validation
-    temp_path = os.path.join(IMAGE_DIR, "temp_validation")
-    with open(temp_path, 'wb') as f:
-        f.write(image_data)
-
-    # Use imghdr to detect file type
-    img_type = imghdr.what(temp_path)
-
-    # Clean up temporary file
-    os.remove(temp_path)
+def parse_page_size(page_size):
+    """Clamp a client-supplied page size to the allowed range"""
+    try:
+        return max(1, min(int(page_size), HISTORY_MAX_PAGE_SIZE))
+    except ValueError:
+        return HISTORY_PAGE_SIZE
 
-    # Check if it's a valid image type
-    valid_types = ['jpeg', 'jpg', 'png']
-    is_valid = img_type in valid_types
 
-    return is_valid
+def get_user_history(username, cursor="", page_size=HISTORY_PAGE_SIZE):
+    """Get one page of a user's analysis history (newest first) and the cursor of the next page"""
+    # The cursor is "<timestamp>:<id>" of the last row the client has already seen
+    if cursor:
+        try:
+            before_timestamp, before_id = (int(part) for part in cursor.split(':'))
+        except ValueError:
+            raise ProtocolError(f"Invalid history cursor: {cursor}")
+    else:
+        before_timestamp, before_id = 2 ** 62, 2 ** 62
 
-def get_user_history(username):
-    """Get the analysis history for a user"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("""
-        SELECT timestamp, image_hash, question, answer 
-        FROM image_cache 
-        WHERE username = ? 
-        ORDER BY timestamp DESC
-    """, (username,))
+        SELECT id, timestamp, datetime(timestamp, 'unixepoch', 'localtime') as formatted_timestamp,
+               image_hash, question, answer, file_path
+        FROM image_cache
+        WHERE username = ? AND (timestamp < ? OR (timestamp = ? AND id < ?))
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    """, (username, before_timestamp, before_timestamp, before_id, page_size + 1))
     history = c.fetchall()
-    conn.close()
-    return history
 
-def handle_client(client_socket, client_address, semaphore):
-    with semaphore:
+    # One extra row tells us whether another page exists
+    next_cursor = ""
+    if len(history) > page_size:
+        history = history[:page_size]
+        last_id, last_timestamp = history[-1][0], history[-1][1]
+        next_cursor = f"{last_timestamp}:{last_id}"
+    return history, next_cursor
+
+def start_signup(username, email):
+    """Check signup details and email a verification code"""
+    if not is_valid_email(email):
+        return False, "Signup failed: Invalid email"
+
+    # Check if username already exists
+    if username_exists(username):
+        return False, "Signup failed: Username already exists"
+
+    # Check if email already exists
+    if email_exists(email):
+        return False, "Signup failed: Email already in use"
+
+    # Generate and send verification code
+    verification_code = generate_verification_code()
+    with span("send_email"):
+        send_verification_email(email, verification_code)
+    log_event("verification_email_sent", username=username)
+    return True, "Verification code sent. Please enter the verification code:"
+
+
+def complete_signup(username, password, email, verification_code):
+    """Create the user and verify it with the code the client entered"""
+    # Hash password with bcrypt
+    hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+
+    # Save user to database
+    save_user(username, hashed_pw, email, 0)
+
+    # Verify the account
+    verified, message = verify_account(email, verification_code)
+    if verified:
+        log_event("signup_completed", username=username)
+        return "Signup successful"
+    return f"Signup failed: {message}"
+
+
+def process_image(username, image_data, image_hash, question, calculated_hash=None):
+    """Answer a question about an uploaded image and return the reply for the client.
+    Raises ModelNotReadyError while the model is loading or after it failed to load."""
+    # Validate image hash (the receive path usually hashes while the bytes arrive)
+    if calculated_hash is None:
+        calculated_hash = hashlib.sha256(image_data).hexdigest()
+    if calculated_hash != image_hash:
+        return "Image hash mismatch."
+
+    # Sniff the image type from its magic bytes; it also decides the stored file's extension
+    with span("is_valid_image"):
+        image_type = detect_image_type(image_data)
+    if image_type is None:
+        return "Invalid image format. Only JPEG, PNG and WebP are supported."
+    image_file_path = blob_path(calculated_hash, image_type)
+    blob = {"mime_type": IMAGE_TYPES[image_type][1], "size": len(image_data)}
+
+    # Serve repeat scans straight from the answer cache
+    with span("cache_lookup"):
+        answer = get_cached_answer(calculated_hash, question)
+    if answer is not None:
+        log_event("answer_cache_hit", image_hash=calculated_hash[:12])
+        CACHE_LOOKUPS.inc(result="hit")
+        # Rewrites the image if retention has deleted it since the answer was cached; both
+        # calls return immediately when the files are already stored
+        with span("persist_enqueue"):
+            persist_image(image_file_path, image_data)
+            persist_thumbnail(calculated_hash, image_data)
+        with span("queue_image_cache"):
+            queue_image_cache(image_hash, username, question, answer, image_file_path, **blob)
+        return answer
+
+    # Open the image once in memory for the model
+    with IMAGE_DECODE_SECONDS.time():
+        try:
+            with span("decode_image"):
+                image = decode_image(image_data)
+        except ValueError:
+            return "Invalid image format. Only JPEG, PNG and WebP are supported."
+
+    # Writing the upload and its thumbnail to disk happens in the background; this only
+    # takes long when the writer has fallen behind and the queue is full
+    with span("persist_enqueue"):
+        persist_image(image_file_path, image_data)
+        persist_thumbnail(calculated_hash, image_data)
+
+    # A new photo of an item we have already answered about can reuse that answer
+    phash = None
+    if NEAR_DUPLICATE_CACHE:
+        with span("near_duplicate_lookup"):
+            phash = perceptual_hash(image_data)
+            match = get_near_duplicate_answer(phash, question)
+        if match is not None:
+            matched_hash, answer = match
+            log_event("near_duplicate_cache_hit", image_hash=calculated_hash[:12], matched_hash=matched_hash[:12])
+            CACHE_LOOKUPS.inc(result="near_duplicate")
+            store_answer(calculated_hash, question, answer)
+            with span("queue_image_cache"):
+                queue_image_cache(image_hash, username, question, answer, image_file_path, f"{phash:016x}",
+                                  **blob)
+            index_phash(phash, calculated_hash)
+            return answer
+
+    # Use the actual AI model query function from vegsecai_model.py
+    CACHE_LOOKUPS.inc(result="miss")
+    with INFERENCE_SECONDS.time(), span("model_query_ai"):
+        answer = model_query_ai(image, question, calculated_hash)
+    store_answer(calculated_hash, question, answer)
+
+    # Cache the image and answer; the row is committed in the background
+    with span("queue_image_cache"):
+        queue_image_cache(image_hash, username, question, answer, image_file_path,
+                          f"{phash:016x}" if phash is not None else None, **blob)
+    if phash is not None:
+        index_phash(phash, calculated_hash)
+    return answer
+
+
+def encode_history_page(username, cursor, page_size):
+    """Encode a history page as FRAME_HISTORY batches, each followed by the thumbnails it references,
+    and an end frame carrying the next cursor"""
+    history, next_cursor = get_user_history(username, cursor, page_size)
+
+    frames = []
+    sent_thumbnails = set()
+    for start in range(0, len(history), HISTORY_ROWS_PER_FRAME):
+        rows = history[start:start + HISTORY_ROWS_PER_FRAME]
+        batch = [
+            {
+                "timestamp": formatted_timestamp,
+                "image_hash": image_hash,
+                "question": question,
+                # Handle None values
+                "answer": answer or "No answer available",
+            }
+            for _, _, formatted_timestamp, image_hash, question, answer, _ in rows
+        ]
+        frames.append(encode_frame(FRAME_HISTORY, json.dumps(batch).encode()))
+
+        for _, _, _, image_hash, _, _, file_path in rows:
+            if image_hash in sent_thumbnails:
+                continue
+            sent_thumbnails.add(image_hash)
+            try:
+                thumbnail = load_thumbnail(image_hash, file_path)
+            except Exception as e:
+                log_event("thumbnail_load_failed", level="warning", image_hash=image_hash[:12], error=str(e))
+                continue
+            if thumbnail:
+                frames.append(encode_frame(FRAME_THUMBNAIL, image_hash.encode() + thumbnail))
+
+    frames.append(encode_frame(FRAME_END, next_cursor.encode()))
+    return frames
+
+
+def _answer_image_request(replies, trace, request_id, username, image_data, image_hash, question, calculated_hash):
+    try:
+        answer = process_image(username, image_data, image_hash, question, calculated_hash)
+        replies.put((FRAME_TEXT, answer.encode(), request_id, trace))
+    except ModelNotReadyError as e:
+        # Sent as an error so clients do not mistake it for an answer and can retry later
+        log_event("model_not_ready", level="warning", error=str(e))
+        replies.put((FRAME_ERROR, str(e).encode(), request_id, trace))
+    except Exception as e:
+        log_event("image_request_failed", level="error", error=str(e))
+        replies.put((FRAME_ERROR, f"Error: {str(e)}".encode(), request_id, trace))
+
+
+def serve_image_requests(client_socket, username, connection_id=None):
+    """Answer pipelined image questions for a logged-in session until the client says goodbye.
+
+    Up to MAX_PIPELINED_REQUESTS are processed at once and each answer is sent as soon as it is
+    ready, tagged with its request id. Only this thread reads or writes the socket: an SSL socket
+    must not be used from several threads at the same time. Every image request is traced
+    separately, linked to the login by connection_id.
+    """
+    replies = queue.Queue()
+    in_flight = 0
+
+    def send_reply(block):
+        nonlocal in_flight
+        frame_type, payload, request_id, trace = replies.get(block)
+        with trace.span("send"):
+            send_frame(client_socket, frame_type, payload, request_id)
+        in_flight -= 1
+        trace.finish(outcome="error" if frame_type == FRAME_ERROR else "ok")
+
+    while True:
+        while not replies.empty():
+            send_reply(False)
+
+        # Stop reading new requests until one finishes
+        if in_flight >= MAX_PIPELINED_REQUESTS:
+            send_reply(True)
+            continue
+
+        # Only start reading once the next request has begun to arrive, so the receive span
+        # times the upload rather than the client's idle time; poll for replies meanwhile
+        if not client_socket.pending():
+            readable, _, _ = select.select([client_socket], [], [], REPLY_POLL_INTERVAL if in_flight else None)
+            if not readable:
+                continue
+
+        trace = Trace("image", username=username, connection_id=connection_id)
+        request_id = 0
         try:
-            print(f"[Server] Connection from {client_address} established.")
-            request_type = client_socket.recv(1024).decode().strip()
+            with trace.span("receive"):
+                # Hash the upload incrementally while it is received into one buffer
+                hasher = hashlib.sha256()
+                frame = recv_frame(client_socket, MAX_UPLOAD_SIZE, hasher)
+                if frame is None:
+                    break
+
+                frame_type, request_id, image_data = frame
+                if frame_type == FRAME_BYE:
+                    log_event("logged_out", username=username)
+                    break
+
+                if frame_type != FRAME_IMAGE:
+                    raise ProtocolError(f"Unexpected frame type {frame_type}")
+                BYTES_RECEIVED.inc(len(image_data))
+
+                image_hash = recv_text(client_socket).strip()
+                question = recv_text(client_socket).strip()
+        except Exception as e:
+            log_event("image_request_failed", level="error", trace_id=trace.id, error=str(e))
+            send_frame(client_socket, FRAME_ERROR, f"Error: {str(e)}".encode(), request_id)
+            break
 
-            if request_type == "signup":
-                # Receive signup details
-                username = client_socket.recv(1024).decode().strip()
-                password = client_socket.recv(1024).decode().strip()
-                email = client_socket.recv(1024).decode().strip()
+        trace.fields.update(request_id=request_id, bytes=len(image_data))
+        in_flight += 1
+        image_executor.submit(call_in_trace, trace, _answer_image_request, replies, trace, request_id, username,
+                              image_data, image_hash, question, hasher.hexdigest())
 
-                if not is_valid_email(email):
-                    client_socket.send("Signup failed: Invalid email".encode())
-                    return
+    # Answer the requests that were already read before the session ended
+    while in_flight:
+        send_reply(True)
 
-                # Check if username already exists
-                if username_exists(username):
-                    client_socket.send("Signup failed: Username already exists".encode())
-                    return
 
-                # Check if email already exists
-                if email_exists(email):
-                    client_socket.send("Signup failed: Email already in use".encode())
-                    return
+def handle_client(client_socket, client_address, semaphore):
+    trace = Trace("connection", client=f"{client_address[0]}:{client_address[1]}")
+    with activate(trace):
+        _handle_connection(client_socket, client_address, semaphore, trace)
 
-                # Generate and send verification code
-                verification_code = generate_verification_code()
-                send_verification_email(email, verification_code)
-                print("[Server] Sent verification email, waiting for client verification input...")
-                # Inform the client to enter the code
-                client_socket.send("Verification code sent. Please enter the verification code:".encode())
 
-                # Wait for the client's verification code
-                client_verification = client_socket.recv(1024).decode().strip()
+def _handle_connection(client_socket, client_address, semaphore, trace):
+    # A trace covers the server's work up to its first reply: interactive flows then wait on
+    # a person, and a login session traces each image request on its own
+    request_type = None
+
+    # Time spent here shows how saturated the connection limit is
+    WAITING_HANDLERS.inc()
+    wait_started = time.perf_counter()
+    with semaphore:
+        SEMAPHORE_WAIT_SECONDS.observe(time.perf_counter() - wait_started)
+        trace.record("semaphore_wait", wait_started, time.perf_counter())
+        WAITING_HANDLERS.dec()
+        ACTIVE_HANDLERS.inc()
+        try:
+            # The accept loop leaves the handshake to this thread so one slow client cannot stall it
+            with span("tls_handshake"):
+                client_socket.do_handshake()
+            log_event("connection_established", client=trace.fields["client"])
+
+            with span("receive"):
+                request_type = recv_text(client_socket).strip()
+            REQUESTS_TOTAL.inc(type=request_type if request_type in REQUEST_TYPES else "invalid")
 
-                # Hash password with bcrypt
-                hashed_pw = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+            if request_type == "signup":
+                # Receive signup details
+                with span("receive"):
+                    username = recv_text(client_socket).strip()
+                    password = recv_text(client_socket).strip()
+                    email = recv_text(client_socket).strip()
 
-                # Save user to database
-                save_user(username, hashed_pw, email, 0)
+                success, message = start_signup(username, email)
+                # Inform the client to enter the code
+                with span("send"):
+                    send_text(client_socket, message)
+                trace.finish(request_type=request_type, username=username)
+                if not success:
+                    return
 
-                # Verify the account
-                verified, message = verify_account(email, client_verification)
-                if verified:
-                    print(f"[Server] Signup completed for username: {username}")
-                    client_socket.send("Signup successful".encode())
-                else:
-                    client_socket.send(f"Signup failed: {message}".encode())
+                # Wait for the client's verification code
+                client_verification = recv_text(client_socket).strip()
+                send_text(client_socket, complete_signup(username, password, email, client_verification))
 
             elif request_type == "login":
-                username = client_socket.recv(1024).decode().strip()
-                password = client_socket.recv(1024).decode().strip()
-
-                success, message = login(username, password, client_address[0])
-                client_socket.send(message.encode())
+                with span("receive"):
+                    username = recv_text(client_socket).strip()
+                    password = recv_text(client_socket).strip()
+
+                with span("login"):
+                    success, message = login(username, password, client_address[0])
+                if not success:
+                    with span("send"):
+                        send_text(client_socket, message)
+                    trace.finish(request_type=request_type, username=username, outcome="rejected")
+                    return
 
-                if success:
-                    print(f"[Server] User {username} logged in successfully")
-                    while True:
-                        try:
-                            length_bytes = client_socket.recv(4)
-                            if not length_bytes or len(length_bytes) == 0:
-                                break
-
-                            if length_bytes == b'#bye':
-                                print(f"[Server] User {username} logged out")
-                                break
-
-                            if len(length_bytes) != 4:
-                                raise ValueError("Invalid length bytes received")
-
-                            image_length = int.from_bytes(length_bytes, 'big')
-                            image_data = b''
-
-                            while len(image_data) < image_length:
-                                chunk = client_socket.recv(min(1024, image_length - len(image_data)))
-                                if not chunk:
-                                    raise ValueError("Connection lost while receiving image data")
-                                image_data += chunk
-
-                            image_hash = client_socket.recv(1024).decode().strip()
-                            question = client_socket.recv(1024).decode().strip()
-
-                            # Validate image hash
-                            calculated_hash = hashlib.sha256(image_data).hexdigest()
-                            if calculated_hash != image_hash:
-                                client_socket.send("Image hash mismatch.".encode())
-                                continue
-
-                            # Validate image type
-                            if not is_valid_image(image_data):
-                                client_socket.send("Invalid image format. Only JPEG and PNG are supported.".encode())
-                                continue
-
-                            image_file_path = os.path.join(IMAGE_DIR, f"{calculated_hash}.jpg")
-                            with open(image_file_path, 'wb') as f:
-                                f.write(image_data)
-
-                            # Use the actual AI model query function from vegsecai_model.py
-                            answer = model_query_ai(image_file_path, question)
-
-                            # Cache the image and answer
-                            save_image_cache(image_hash, username, question, answer, image_file_path)
-
-                            client_socket.send(answer.encode())
-                        except Exception as e:
-                            print(f"[Server] Error processing image: {e}")
-                            client_socket.send(f"Error: {str(e)}".encode())
-                            break
+                # The session token follows the reply; it is valid while this connection is open
+                token = create_session(username)
+                with span("send"):
+                    send_texts(client_socket, [message, token])
+                trace.finish(request_type=request_type, username=username, outcome="ok")
+                try:
+                    serve_image_requests(client_socket, username, trace.id)
+                finally:
+                    end_session(token)
 
             elif request_type == "forgot_password":
-                email = client_socket.recv(1024).decode().strip()
-                success, message = forgot_password(email)
-                client_socket.send(message.encode())
+                with span("receive"):
+                    email = recv_text(client_socket).strip()
+                with span("forgot_password"):
+                    success, message = forgot_password(email)
+                with span("send"):
+                    send_text(client_socket, message)
+                trace.finish(request_type=request_type)
 
                 if success:
                     # Wait for user to enter reset information
-                    username = client_socket.recv(1024).decode().strip()
-                    reset_token = client_socket.recv(1024).decode().strip()
-                    new_password = client_socket.recv(1024).decode().strip()
+                    username = recv_text(client_socket).strip()
+                    reset_token = recv_text(client_socket).strip()
+                    new_password = recv_text(client_socket).strip()
 
                     reset_success, reset_message = reset_password(username, reset_token, new_password)
-                    client_socket.send(reset_message.encode())
-
+                    send_text(client_socket, reset_message)
 
             elif request_type == "get_history":
+                with span("receive"):
+                    token = recv_text(client_socket).strip()
+                    cursor = recv_text(client_socket).strip()
+                    page_size = parse_page_size(recv_text(client_socket))
+
+                # Only the logged-in user may read their history
+                username = session_username(token)
+                if username is None:
+                    send_frame(client_socket, FRAME_ERROR, NOT_LOGGED_IN.encode())
+                    trace.fields["outcome"] = "rejected"
+                    return
 
-                username = client_socket.recv(1024).decode().strip()
-
-                # Get history entries with timestamp
-
-                conn = sqlite3.connect(DATABASE)
-
-                c = conn.cursor()
-
-                c.execute("""
-
-                                SELECT datetime(timestamp, 'unixepoch', 'localtime') as formatted_timestamp, 
-
-                                       image_hash, question, answer 
-
-                                FROM image_cache 
-
-                                WHERE username = ? 
-
-                                ORDER BY timestamp DESC
-
-                            """, (username,))
-
-                history = c.fetchall()
-
-                conn.close()
-
-                # Send history entries
-
-                if not history:
-
-                    client_socket.send("END_HISTORY".encode())
-
-                else:
+                # Stream the page as batched frames followed by an end marker
+                try:
+                    with span("history_query"):
+                        frames = encode_history_page(username, cursor, page_size)
+                except ProtocolError as e:
+                    # A bad cursor; without a reply the client would take the closed connection for the last page
+                    send_frame(client_socket, FRAME_ERROR, str(e).encode())
+                    trace.fields["outcome"] = "rejected"
+                    return
+                with span("send"):
+                    for frame in frames:
+                        client_socket.sendall(frame)
+                trace.fields["username"] = username
 
-                    if not history:
-                        client_socket.send("END_HISTORY".encode())
-                    else:
-                        # Send each entry with END_HISTORY separator
-                        for entry in history:
-                            timestamp, image_hash, question, answer = entry
-                            # Handle None values
-                            answer = answer or "No answer available"  # Add default if None
-                            entry_data = f"{timestamp}|{image_hash}|{question.replace('|', '&#124;')}|{answer.replace('|', '&#124;')}"
-                            client_socket.send(f"{entry_data}END_HISTORY".encode())
+            elif request_type == "upload_settings":
+                # Lets clients downscale and re-encode before uploading
+                send_text(client_socket, json.dumps(upload_settings()))
 
             else:
-                client_socket.send("Invalid request type".encode())
+                send_text(client_socket, "Invalid request type")
 
         except Exception as e:
-            print(f"[Server] Error handling client: {e}")
+            log_event("connection_error", level="error", error=str(e))
+            trace.fields["outcome"] = "error"
         finally:
             try:
                 client_socket.close()
             except:
                 pass
-            print(f"[Server] Connection from {client_address} closed.")
\ No newline at end of file
+            ACTIVE_HANDLERS.dec()
+            trace.finish(request_type=request_type)
+            log_event("connection_closed", client=trace.fields["client"])
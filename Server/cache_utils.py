@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from db_utils import (
+    get_cached_answer as db_get_cached_answer, get_image_phashes, get_referenced_hashes, normalize_question
+)
+
+load_dotenv()
+
+# Answer cache configuration
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 2048))  # entries kept in memory
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 7 * 24 * 60 * 60))  # 7 days in seconds
+
+# Near-duplicate lookup: re-photographs of the same item reuse an answer when their
+# 64-bit perceptual hashes differ in at most PHASH_MAX_DISTANCE bits
+NEAR_DUPLICATE_CACHE = os.getenv("NEAR_DUPLICATE_CACHE", "0") == "1"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 4))
+
+# Function declarations:
+# class LRUCache(max_entries: int | None, max_bytes: int | None, ttl: int | None, sizeof: callable | None)
+# class BKTree()
+# def hamming_distance(a: int, b: int) -> int
+# def get_cached_answer(image_hash: str, question: str) -> str | None
+# def store_answer(image_hash: str, question: str, answer: str) -> None
+# def index_phash(phash: int, image_hash: str) -> None
+# def get_near_duplicate_answer(phash: int, question: str) -> tuple[str, str] | None
+# def forget_answers(rows: list[tuple[str, str, str | None]]) -> None
+# def answer_cache_stats() -> dict
+
+
+class LRUCache:
+    """Thread-safe LRU cache with optional entry count, byte budget and TTL limits"""
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, size, stored_at)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, size, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value and evict least recently used entries beyond the limits"""
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # Never keep a single value that is larger than the whole budget
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size, time.time())
+            self.total_bytes += size
+
+            while self._entries and (
+                (self.max_entries is not None and len(self._entries) > self.max_entries) or
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+            ):
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def pop(self, key):
+        """Remove a key from the cache if present"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """Thread-safe BK-tree over 64-bit hashes for Hamming-distance range queries"""
+
+    def __init__(self):
+        self.root = None  # [hash, values, {distance: child}]
+        self.size = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, value):
+        with self._lock:
+            if self.root is None:
+                self.root = [key, [value], {}]
+                self.size = 1
+                return
+            node = self.root
+            while True:
+                distance = hamming_distance(key, node[0])
+                if distance == 0:
+                    if value not in node[1]:
+                        node[1].append(value)
+                    return
+                child = node[2].get(distance)
+                if child is None:
+                    node[2][distance] = [key, [value], {}]
+                    self.size += 1
+                    return
+                node = child
+
+    def discard(self, key, value):
+        """Remove value from key's node; the node stays in place to keep routing its children"""
+        with self._lock:
+            node = self.root
+            while node is not None:
+                distance = hamming_distance(key, node[0])
+                if distance == 0:
+                    if value in node[1]:
+                        node[1].remove(value)
+                    return
+                node = node[2].get(distance)
+
+    def search(self, key, max_distance):
+        """Return (distance, value) pairs within max_distance of key, closest first"""
+        results = []
+        with self._lock:
+            stack = [self.root] if self.root is not None else []
+            while stack:
+                node = stack.pop()
+                distance = hamming_distance(key, node[0])
+                if distance <= max_distance:
+                    results.extend((distance, value) for value in node[1])
+                # Triangle inequality: only children in this distance band can match
+                for child_distance, child in node[2].items():
+                    if distance - max_distance <= child_distance <= distance + max_distance:
+                        stack.append(child)
+        return sorted(results)
+
+
+# In-process layer in front of the image_cache table
+answer_cache = LRUCache(max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+db_hits = 0
+db_misses = 0
+near_duplicate_hits = 0
+stats_lock = threading.Lock()
+
+# Perceptual hash -> image hashes, filled from image_cache on first use
+phash_index = BKTree()
+phash_index_loaded = False
+phash_index_lock = threading.Lock()
+
+
+def get_cached_answer(image_hash, question):
+    """Look up a previous answer for (image hash, normalized question), memory first then SQLite"""
+    global db_hits, db_misses
+    key = (image_hash, normalize_question(question))
+
+    answer = answer_cache.get(key)
+    if answer is not None:
+        return answer
+
+    min_timestamp = int(time.time()) - ANSWER_CACHE_TTL
+    answer = db_get_cached_answer(image_hash, key[1], min_timestamp)
+
+    with stats_lock:
+        if answer is None:
+            db_misses += 1
+        else:
+            db_hits += 1
+
+    if answer is not None:
+        answer_cache.put(key, answer)
+    return answer
+
+
+def store_answer(image_hash, question, answer):
+    """Remember a freshly computed answer in the in-process cache"""
+    if answer:
+        answer_cache.put((image_hash, normalize_question(question)), answer)
+
+
+def _ensure_phash_index():
+    global phash_index_loaded
+    with phash_index_lock:
+        if phash_index_loaded:
+            return
+        for image_hash, phash in get_image_phashes():
+            phash_index.add(int(phash, 16), image_hash)
+        phash_index_loaded = True
+
+
+def index_phash(phash, image_hash):
+    """Make an image findable by near-duplicate lookups"""
+    _ensure_phash_index()
+    phash_index.add(phash, image_hash)
+
+
+def get_near_duplicate_answer(phash, question):
+    """Find a cached answer to the same question about a visually near-identical image.
+
+    Returns (matched image hash, answer) for the closest match, or None.
+    """
+    global near_duplicate_hits
+    _ensure_phash_index()
+    for _, image_hash in phash_index.search(phash, PHASH_MAX_DISTANCE):
+        answer = get_cached_answer(image_hash, question)
+        if answer is not None:
+            with stats_lock:
+                near_duplicate_hits += 1
+            return image_hash, answer
+    return None
+
+
+def forget_answers(rows):
+    """Drop cached answers for deleted image_cache rows, given as (image_hash, question_key, phash),
+    and stop matching near-duplicates against images no row references any more"""
+    for image_hash, question_key, _ in rows:
+        answer_cache.pop((image_hash, question_key))
+
+    with phash_index_lock:
+        if not phash_index_loaded:
+            return
+    phashes = {image_hash: phash for image_hash, _, phash in rows if phash}
+    referenced = get_referenced_hashes(list(phashes))
+    for image_hash, phash in phashes.items():
+        if image_hash not in referenced:
+            phash_index.discard(int(phash, 16), image_hash)
+
+
+def answer_cache_stats():
+    """Return hit/miss counters for the memory and SQLite cache layers"""
+    stats = answer_cache.stats()
+    with stats_lock:
+        stats["db_hits"] = db_hits
+        stats["db_misses"] = db_misses
+        stats["near_duplicate_hits"] = near_duplicate_hits
+    stats["phash_index_size"] = phash_index.size
+    return stats
@@ -1,10 +1,41 @@
 import sqlite3
 import os
+import queue
+import threading
 import time
+from metrics_utils import CACHE_WRITE_QUEUE_DEPTH, DB_QUERY_SECONDS
+from trace_utils import log_event
 
 DATABASE = 'user_data.db'
+BUSY_TIMEOUT = 5.0  # seconds a connection waits on a locked database before failing
+STATEMENT_CACHE_SIZE = 128  # prepared statements kept per connection
+
+# Write-behind for image_cache rows: answers go back to the client before their row is
+# committed, and rows that queue up meanwhile are inserted together in one transaction
+CACHE_WRITE_QUEUE_SIZE = int(os.getenv("CACHE_WRITE_QUEUE_SIZE", 1024))
+CACHE_WRITE_BATCH_SIZE = int(os.getenv("CACHE_WRITE_BATCH_SIZE", 128))
+
+IMAGE_CACHE_INSERT = """
+    INSERT INTO image_cache
+    (image_hash, username, question, question_key, answer, file_path, timestamp, phash)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+# Records the MIME type and size of a stored image; its reference count is kept by triggers
+IMAGE_BLOB_INSERT = """
+    INSERT INTO image_blobs (image_hash, file_path, mime_type, size, ref_count, created)
+    VALUES (?, ?, ?, ?, 0, ?)
+    ON CONFLICT(image_hash) DO UPDATE SET
+        mime_type = coalesce(image_blobs.mime_type, excluded.mime_type),
+        size = coalesce(image_blobs.size, excluded.size)
+"""
+
+# One connection per thread, reused across calls
+_local = threading.local()
 
 # Function prototypes:
+# class TimedCursor(connection: sqlite3.Connection)
+# class TimedConnection(database: str, **kwargs)
+# def get_connection() -> sqlite3.Connection
 # def init_db(): -> None
 # def username_exists(username: str) -> bool
 # def email_exists(email: str) -> bool
@@ -18,11 +49,86 @@ DATABASE = 'user_data.db'
 # def save_reset_token(username: str, reset_token: str, expiry_time: int) -> None
 # def get_reset_token(username: str) -> tuple | None
 # def update_password(username: str, hashed_pw: str) -> None
-# def save_image_cache(image_hash: str, username: str, answer: str, file_path: str) -> None
+# def save_image_cache(image_hash: str, username: str, question: str, answer: str, file_path: str, phash: str | None = None) -> None
+# def queue_image_cache(image_hash: str, username: str, question: str, answer: str, file_path: str, phash: str | None = None, mime_type: str | None = None, size: int | None = None) -> None
+# def flush_image_cache() -> None
+# def get_unreferenced_blobs(released_before: int, limit: int) -> list[tuple[str, str]]
+# def delete_blob_record(image_hash: str) -> bool
+# def get_known_blobs(image_hashes: list[str]) -> set[str]
+# def get_blobs_without_size(limit: int) -> list[tuple[str, str]]
+# def set_blob_size(image_hash: str, size: int) -> None
+# def get_image_cache_users() -> list[str]
+# def get_image_cache_user_counts(min_rows: int) -> list[tuple[str, int]]
+# def get_image_cache_usage(username: str | None = None) -> tuple[int, int]
+# def delete_oldest_image_cache(limit: int, username: str | None = None, before: int | None = None) -> list[tuple[str, str, str | None]]
+# def get_referenced_hashes(image_hashes: list[str]) -> set[str]
+# def get_vacuum_state() -> tuple[int, int, int]
+# def incremental_vacuum(pages: int) -> None
+# def vacuum() -> None
+# def get_cached_answer(image_hash: str, question_key: str, min_timestamp: int = 0) -> str | None
+# def get_image_phashes() -> list[tuple[str, str]]
+# def normalize_question(question: str) -> str
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records statement execution time, labelled by the leading SQL keyword"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=_statement_kind(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, statement=_statement_kind(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose cursors (and shortcut execute) are timed"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+
+def _statement_kind(sql):
+    # Keeps the label set small: SELECT, INSERT, UPDATE, DELETE, BEGIN, COMMIT, PRAGMA, ...
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ""
+
+
+def get_connection():
+    """Return this thread's SQLite connection, opening and tuning it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and _local.database == DATABASE:
+        return conn
+
+    # Autocommit: single-statement writes never leave a transaction (and its lock) open
+    # on a reused connection; multi-statement work opens one explicitly with BEGIN
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE,
+                           isolation_level=None, factory=TimedConnection)
+    # Lets retention hand freed pages back to the filesystem with incremental_vacuum. It must be
+    # set before anything writes a new database file; an existing one switches on its next VACUUM.
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe in WAL mode
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+    _local.conn = conn
+    _local.database = DATABASE
+    return conn
+
 
 def init_db():
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
+    c.execute("BEGIN")
     c.execute('''CREATE TABLE IF NOT EXISTS users (
                     username TEXT PRIMARY KEY,
                     password_hash TEXT,
@@ -37,153 +143,480 @@ def init_db():
                     expiry INTEGER
                 )''')
     c.execute('''CREATE TABLE IF NOT EXISTS image_cache (
-                    image_hash TEXT PRIMARY KEY,
+                    id INTEGER PRIMARY KEY,
+                    image_hash TEXT,
                     username TEXT,
                     question TEXT,
+                    question_key TEXT,
                     answer TEXT,
                     file_path TEXT,
-                    timestamp INTEGER
+                    timestamp INTEGER,
+                    phash TEXT
                 )''')
     # Add a unique index on email to enforce uniqueness at the database level
     c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users(email)''')
 
     # Check and add timestamp column if not exists
     c.execute("PRAGMA table_info(image_cache)")
-    columns = [column[1] for column in c.fetchall()]
+    table_info = c.fetchall()
+    columns = [column[1] for column in table_info]
     if 'timestamp' not in columns:
         c.execute("ALTER TABLE image_cache ADD COLUMN timestamp INTEGER")
 
+    # Older databases keyed image_cache by image_hash alone, so a second question
+    # about the same image replaced the first one. Rebuild them with one row per answer.
+    if 'id' not in columns:
+        _migrate_image_cache(c)
+
+    # Perceptual hash (hex dHash) used to find near-duplicate photos
+    if 'phash' not in columns:
+        c.execute("ALTER TABLE image_cache ADD COLUMN phash TEXT")
+
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_image_cache_lookup
+                 ON image_cache(image_hash, question_key, timestamp)''')
+
+    # Keyset pagination of a user's history walks this index newest first
+    c.execute("UPDATE image_cache SET timestamp = 0 WHERE timestamp IS NULL")
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_image_cache_history
+                 ON image_cache(username, timestamp, id)''')
+    # Retention deletes the oldest rows across all users
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_image_cache_timestamp
+                 ON image_cache(timestamp, id)''')
+
+    _create_image_blobs(c)
+
     conn.commit()
-    conn.close()
     print("[Server] Database initialized.")
 
 
+def _create_image_blobs(c):
+    """One row per stored image, counting the image_cache rows that reference it"""
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'image_blobs'")
+    exists = c.fetchone() is not None
+    c.execute('''CREATE TABLE IF NOT EXISTS image_blobs (
+                    image_hash TEXT PRIMARY KEY,
+                    file_path TEXT,
+                    mime_type TEXT,
+                    size INTEGER,
+                    ref_count INTEGER NOT NULL DEFAULT 0,
+                    created INTEGER,
+                    released INTEGER
+                )''')
+    if not exists:
+        # Count the references of images stored before the table existed
+        c.execute('''INSERT INTO image_blobs (image_hash, file_path, ref_count, created)
+                     SELECT image_hash, MAX(file_path), COUNT(*), MIN(timestamp)
+                     FROM image_cache GROUP BY image_hash''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_image_blobs_unreferenced
+                 ON image_blobs(released) WHERE ref_count <= 0''')
+
+    # Triggers keep ref_count in step with image_cache however rows are added or removed
+    c.execute('''CREATE TRIGGER IF NOT EXISTS image_cache_blob_ref AFTER INSERT ON image_cache
+                 BEGIN
+                     INSERT INTO image_blobs (image_hash, file_path, ref_count, created)
+                     VALUES (NEW.image_hash, NEW.file_path, 1, NEW.timestamp)
+                     ON CONFLICT(image_hash) DO UPDATE SET ref_count = ref_count + 1, released = NULL;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS image_cache_blob_unref AFTER DELETE ON image_cache
+                 BEGIN
+                     UPDATE image_blobs SET ref_count = ref_count - 1, released = CAST(strftime('%s', 'now') AS INTEGER)
+                     WHERE image_hash = OLD.image_hash;
+                 END''')
+
+
+def _migrate_image_cache(c):
+    """Rebuild a legacy image_cache table (image_hash primary key) with a row id and question_key"""
+    c.execute("ALTER TABLE image_cache RENAME TO image_cache_legacy")
+    c.execute('''CREATE TABLE image_cache (
+                    id INTEGER PRIMARY KEY,
+                    image_hash TEXT,
+                    username TEXT,
+                    question TEXT,
+                    question_key TEXT,
+                    answer TEXT,
+                    file_path TEXT,
+                    timestamp INTEGER
+                )''')
+    c.execute("SELECT image_hash, username, question, answer, file_path, timestamp FROM image_cache_legacy")
+    rows = [
+        (image_hash, username, question, normalize_question(question or ""), answer, file_path, timestamp)
+        for image_hash, username, question, answer, file_path, timestamp in c.fetchall()
+    ]
+    c.executemany("""
+        INSERT INTO image_cache
+        (image_hash, username, question, question_key, answer, file_path, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    c.execute("DROP TABLE image_cache_legacy")
+    print(f"[Server] Migrated {len(rows)} image_cache rows to the new schema.")
+
+
+def normalize_question(question):
+    """Normalize a question so trivially different phrasings share a cache key"""
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+
 def username_exists(username):
     """Check if a username already exists in the database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE username=?", (username,))
     exists = c.fetchone() is not None
-    conn.close()
     return exists
 
 
 def email_exists(email):
     """Check if an email already exists in the database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE email=?", (email,))
     exists = c.fetchone() is not None
-    conn.close()
     return exists
 
 
 def save_user(username, hashed_pw, email, verified=0):
     """Save a new user to the database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("INSERT INTO users (username, password_hash, email, verified) VALUES (?, ?, ?, ?)",
               (username, hashed_pw, email, verified))
     conn.commit()
-    conn.close()
 
 
 def get_user_by_username(username):
     """Get user data by username"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT password_hash, verified, email FROM users WHERE username=?", (username,))
     user_data = c.fetchone()
-    conn.close()
     return user_data
 
 
 def get_user_by_email(email):
     """Get user data by email"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT username FROM users WHERE email=?", (email,))
     user_data = c.fetchone()
-    conn.close()
     return user_data
 
 
 def save_verification_code(email, code, expiry):
     """Save verification code to database"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("INSERT OR REPLACE INTO verification_codes (email, code, expiry) VALUES (?, ?, ?)",
               (email, code, expiry))
     conn.commit()
-    conn.close()
 
 
 def get_verification_code(email):
     """Get verification code for email"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT code, expiry FROM verification_codes WHERE email=?", (email,))
     verification_data = c.fetchone()
-    conn.close()
     return verification_data
 
 
 def mark_account_verified(email):
     """Mark user account as verified"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("UPDATE users SET verified=1 WHERE email=?", (email,))
     conn.commit()
-    conn.close()
 
 
 def delete_verification_code(email):
     """Delete verification code after use"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("DELETE FROM verification_codes WHERE email=?", (email,))
     conn.commit()
-    conn.close()
 
 
 def save_reset_token(username, reset_token, expiry_time):
     """Save password reset token"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("UPDATE users SET reset_token=?, token_expiry=? WHERE username=?",
               (reset_token, expiry_time, username))
     conn.commit()
-    conn.close()
 
 
 def get_reset_token(username):
     """Get reset token data for username"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("SELECT reset_token, token_expiry FROM users WHERE username=?", (username,))
     token_data = c.fetchone()
-    conn.close()
     return token_data
 
 
 def update_password(username, hashed_pw):
     """Update user password and clear reset token"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
     c = conn.cursor()
     c.execute("UPDATE users SET password_hash=?, reset_token=NULL, token_expiry=NULL WHERE username=?",
               (hashed_pw, username))
     conn.commit()
-    conn.close()
 
 
-def save_image_cache(image_hash, username, question, answer, file_path):
+def _image_cache_row(image_hash, username, question, answer, file_path, phash):
+    return (image_hash, username, question, normalize_question(question), answer or "", file_path,
+            int(time.time()), phash)  # Handle None answers
+
+
+def save_image_cache(image_hash, username, question, answer, file_path, phash=None):
     """Save image and answer to cache with timestamp"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(IMAGE_CACHE_INSERT, _image_cache_row(image_hash, username, question, answer, file_path, phash))
+
+
+def _insert_image_cache_rows(items):
+    """Commit (image_cache row, image_blobs row or None) pairs"""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        # IMMEDIATE takes the write lock up front instead of upgrading from a read lock mid-transaction
+        c.execute("BEGIN IMMEDIATE")
+        c.executemany(IMAGE_BLOB_INSERT, [blob for _, blob in items if blob is not None])
+        c.executemany(IMAGE_CACHE_INSERT, [row for row, _ in items])
+        c.execute("COMMIT")
+        return
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        log_event("image_cache_batch_failed", level="error", rows=len(items), error=str(e))
+
+    # Retry one row at a time so a single bad row does not lose the whole batch
+    for row, blob in items:
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            if blob is not None:
+                c.execute(IMAGE_BLOB_INSERT, blob)
+            c.execute(IMAGE_CACHE_INSERT, row)
+            c.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                c.execute("ROLLBACK")
+            log_event("image_cache_write_failed", level="error", image_hash=row[0][:12], error=str(e))
+
+
+def _cache_writer_loop():
+    while True:
+        items = [cache_write_queue.get()]
+        while len(items) < CACHE_WRITE_BATCH_SIZE:
+            try:
+                items.append(cache_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _insert_image_cache_rows(items)
+        except Exception as e:
+            log_event("image_cache_batch_failed", level="error", rows=len(items), error=str(e))
+        finally:
+            for _ in items:
+                cache_write_queue.task_done()
+
+
+cache_write_queue = queue.Queue(maxsize=CACHE_WRITE_QUEUE_SIZE)
+CACHE_WRITE_QUEUE_DEPTH.set_function(cache_write_queue.qsize)
+cache_writer_thread = None
+cache_writer_lock = threading.Lock()
+
+
+def queue_image_cache(image_hash, username, question, answer, file_path, phash=None, mime_type=None, size=None):
+    """Queue an image_cache row to be committed in the background (timestamped now)"""
+    global cache_writer_thread
+    with cache_writer_lock:
+        if cache_writer_thread is None:
+            cache_writer_thread = threading.Thread(target=_cache_writer_loop, name="cache-writer", daemon=True)
+            cache_writer_thread.start()
+    # Blocks when the writer falls behind, which slows requests down instead of growing memory
+    row = _image_cache_row(image_hash, username, question, answer, file_path, phash)
+    blob = (image_hash, file_path, mime_type, size, row[6]) if mime_type else None
+    cache_write_queue.put((row, blob))
+
+
+def flush_image_cache():
+    """Wait until every queued image_cache row has been committed"""
+    if cache_writer_thread is not None:
+        cache_write_queue.join()
+
+
+def get_unreferenced_blobs(released_before, limit):
+    """Stored images no image_cache row has referenced since released_before, as (image_hash, file_path)"""
+    conn = get_connection()
     c = conn.cursor()
     c.execute("""
-        INSERT OR REPLACE INTO image_cache 
-        (image_hash, username, question, answer, file_path, timestamp) 
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (image_hash, username, question, answer or "", file_path, int(time.time())))  # Handle None answers
-    conn.commit()
-    conn.close()
\ No newline at end of file
+        SELECT image_hash, file_path FROM image_blobs
+        WHERE ref_count <= 0 AND released < ?
+        LIMIT ?
+    """, (released_before, limit))
+    return c.fetchall()
+
+
+def delete_blob_record(image_hash):
+    """Forget a stored image, unless a new image_cache row has referenced it meanwhile"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("DELETE FROM image_blobs WHERE image_hash = ? AND ref_count <= 0", (image_hash,))
+    return c.rowcount > 0
+
+
+def get_known_blobs(image_hashes):
+    """Return the subset of image_hashes that have an image_blobs row"""
+    conn = get_connection()
+    c = conn.cursor()
+    known = set()
+    # Stay well below SQLite's limit on bound parameters
+    for start in range(0, len(image_hashes), 500):
+        chunk = image_hashes[start:start + 500]
+        c.execute(f"SELECT image_hash FROM image_blobs WHERE image_hash IN ({','.join('?' * len(chunk))})", chunk)
+        known.update(row[0] for row in c.fetchall())
+    return known
+
+
+def get_cached_answer(image_hash, question_key, min_timestamp=0):
+    """Get the most recent stored answer for an image and normalized question"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("""
+        SELECT answer FROM image_cache
+        WHERE image_hash = ? AND question_key = ? AND timestamp >= ? AND answer != ''
+        ORDER BY timestamp DESC
+        LIMIT 1
+    """, (image_hash, question_key, min_timestamp))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def get_image_phashes():
+    """Get every distinct (image_hash, phash) pair that has a perceptual hash"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT DISTINCT image_hash, phash FROM image_cache WHERE phash IS NOT NULL")
+    return c.fetchall()
+
+
+def get_blobs_without_size(limit):
+    """Stored images recorded before sizes were tracked, as (image_hash, file_path)"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT image_hash, file_path FROM image_blobs WHERE size IS NULL LIMIT ?", (limit,))
+    return c.fetchall()
+
+
+def set_blob_size(image_hash, size):
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("UPDATE image_blobs SET size = ? WHERE image_hash = ?", (size, image_hash))
+
+
+def get_image_cache_users():
+    """Every username with at least one image_cache row"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT DISTINCT username FROM image_cache")
+    return [row[0] for row in c.fetchall()]
+
+
+def get_image_cache_user_counts(min_rows):
+    """Users with more than min_rows image_cache rows, as (username, row count)"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("SELECT username, COUNT(*) FROM image_cache GROUP BY username HAVING COUNT(*) > ?", (min_rows,))
+    return c.fetchall()
+
+
+def get_image_cache_usage(username=None):
+    """(rows, bytes of the distinct stored images they reference) for one user or the whole table"""
+    conn = get_connection()
+    c = conn.cursor()
+    if username is None:
+        c.execute("SELECT COUNT(*) FROM image_cache")
+        rows = c.fetchone()[0]
+        c.execute("SELECT COALESCE(SUM(size), 0) FROM image_blobs WHERE ref_count > 0")
+    else:
+        c.execute("SELECT COUNT(*) FROM image_cache WHERE username = ?", (username,))
+        rows = c.fetchone()[0]
+        c.execute("""
+            SELECT COALESCE(SUM(size), 0) FROM image_blobs
+            WHERE image_hash IN (SELECT image_hash FROM image_cache WHERE username = ?)
+        """, (username,))
+    return rows, c.fetchone()[0]
+
+
+def delete_oldest_image_cache(limit, username=None, before=None):
+    """Delete up to limit of the oldest image_cache rows, optionally only one user's or only rows
+    older than before, in one short transaction; returns their (image_hash, question_key, phash)"""
+    conditions, params = [], []
+    if username is not None:
+        conditions.append("username = ?")
+        params.append(username)
+    if before is not None:
+        conditions.append("timestamp < ?")
+        params.append(before)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = get_connection()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(f"""
+            SELECT id, image_hash, question_key, phash FROM image_cache {where}
+            ORDER BY timestamp, id LIMIT ?
+        """, (*params, limit))
+        rows = c.fetchall()
+        # Stay well below SQLite's limit on bound parameters
+        for start in range(0, len(rows), 500):
+            ids = [row[0] for row in rows[start:start + 500]]
+            c.execute(f"DELETE FROM image_cache WHERE id IN ({','.join('?' * len(ids))})", ids)
+        c.execute("COMMIT")
+    except sqlite3.Error:
+        if conn.in_transaction:
+            c.execute("ROLLBACK")
+        raise
+    return [row[1:] for row in rows]
+
+
+def get_referenced_hashes(image_hashes):
+    """Return the subset of image_hashes that some image_cache row still references"""
+    conn = get_connection()
+    c = conn.cursor()
+    referenced = set()
+    for start in range(0, len(image_hashes), 500):
+        chunk = image_hashes[start:start + 500]
+        c.execute(f"""
+            SELECT image_hash FROM image_blobs
+            WHERE ref_count > 0 AND image_hash IN ({','.join('?' * len(chunk))})
+        """, chunk)
+        referenced.update(row[0] for row in c.fetchall())
+    return referenced
+
+
+def get_vacuum_state():
+    """(auto_vacuum mode: 0 none, 1 full, 2 incremental; free pages; total pages)"""
+    conn = get_connection()
+    c = conn.cursor()
+    state = []
+    for pragma in ("auto_vacuum", "freelist_count", "page_count"):
+        c.execute(f"PRAGMA {pragma}")
+        state.append(c.fetchone()[0])
+    return tuple(state)
+
+
+def incremental_vacuum(pages):
+    """Return up to pages free pages to the filesystem (auto_vacuum=INCREMENTAL databases only)"""
+    conn = get_connection()
+    c = conn.cursor()
+    # The pragma frees one page per result row, so the rows must be consumed
+    c.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+    c.fetchall()
+
+
+def vacuum():
+    """Rebuild the whole database file; blocks writers until it finishes"""
+    conn = get_connection()
+    conn.execute("VACUUM")
@@ -7,6 +7,8 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from db_utils import save_verification_code
+from metrics_utils import EMAILS_TOTAL
+from trace_utils import log_event
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -34,7 +36,8 @@ def is_valid_email(email):
 def send_email(email, subject, body):
     """Send email to user"""
     if not SMTP_EMAIL or not SMTP_PASSWORD:
-        print("[Server] SMTP credentials are missing!")
+        log_event("email_failed", level="error", error="SMTP credentials are missing")
+        EMAILS_TOTAL.inc(result="failed")
         return False
     msg = MIMEMultipart()
     msg['From'] = SMTP_EMAIL
@@ -47,10 +50,12 @@ def send_email(email, subject, body):
         text = msg.as_string()
         server.sendmail(SMTP_EMAIL, email, text)
         server.quit()
-        print(f"[Server] Email sent to {email}.")
+        log_event("email_sent", email=email)
+        EMAILS_TOTAL.inc(result="sent")
         return True
     except Exception as e:
-        print(f"[Server] Error sending email: {e}")
+        log_event("email_failed", level="error", email=email, error=str(e))
+        EMAILS_TOTAL.inc(result="failed")
         return False
 
 
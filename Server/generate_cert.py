@@ -5,6 +5,7 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 import datetime
 import os
+import ssl
 
 CERT_FILE = "server.crt"
 KEY_FILE = "server.key"
@@ -59,5 +60,12 @@ def generate_self_signed_cert():
     print("[Certificate] Certificate generated successfully.")
     return CERT_FILE, KEY_FILE
 
+def create_server_ssl_context():
+    """Build the server-side TLS context from the (possibly freshly generated) certificate"""
+    cert_file, key_file = generate_self_signed_cert()
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+    return context
+
 if __name__ == "__main__":
     generate_self_signed_cert()
\ No newline at end of file
@@ -0,0 +1,341 @@
+import glob
+import io
+import os
+import queue
+import re
+import threading
+import time
+from PIL import Image, features
+from db_utils import delete_blob_record, get_known_blobs, get_unreferenced_blobs
+from metrics_utils import BLOBS_COLLECTED, PERSIST_QUEUE_DEPTH
+from trace_utils import log_event
+
+# Write-behind persistence of uploaded images
+PERSIST_UPLOADS = os.getenv("PERSIST_UPLOADS", "1") == "1"
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", 64))
+
+# Content-addressed image store: IMAGE_DIR/ab/cd/<sha256>.<ext>, so no directory holds
+# more than a few files however many images are stored
+IMAGE_DIR = os.getenv("IMAGE_DIR", "images")
+EMBEDDING_DIR = os.path.join(IMAGE_DIR, 'embeddings')
+# Detected type -> (file extension, MIME type)
+IMAGE_TYPES = {
+    'jpeg': ('jpg', 'image/jpeg'),
+    'png': ('png', 'image/png'),
+    'webp': ('webp', 'image/webp'),
+}
+
+# Garbage collection of images no image_cache row references any more; files and blobs
+# must have been unreferenced for BLOB_GC_GRACE seconds, which covers queued rows
+BLOB_GC_INTERVAL = int(os.getenv("BLOB_GC_INTERVAL", 60 * 60))  # 0 disables the collector
+BLOB_GC_GRACE = int(os.getenv("BLOB_GC_GRACE", 60 * 60))
+BLOB_GC_BATCH = 500
+SHARD_NAME = re.compile(r'^[0-9a-f]{2}$')
+
+# Content-addressed thumbnails served with the history view, sharded like the images
+THUMBNAIL_DIR = 'thumbnails'
+THUMBNAIL_SIZE = (128, 128)
+THUMBNAIL_QUALITY = 75
+THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+# Largest edge clients should send; they downscale before uploading
+UPLOAD_MAX_EDGE = int(os.getenv("UPLOAD_MAX_EDGE", 1024))
+
+# Leading bytes of the formats we accept
+IMAGE_SIGNATURES = {
+    'jpeg': b'\xff\xd8\xff',
+    'png': b'\x89PNG\r\n\x1a\n',
+}
+WEBP_SUPPORTED = features.check('webp')
+
+# Function declarations:
+# def upload_settings() -> dict
+# def detect_image_type(image_data: bytes) -> str | None
+# def decode_image(image_data: bytes) -> Image.Image
+# def make_thumbnail(image_data: bytes) -> bytes
+# def perceptual_hash(image_data: bytes) -> int
+# def shard_path(directory: str, image_hash: str, extension: str) -> str
+# def blob_path(image_hash: str, image_type: str) -> str
+# def thumbnail_path(image_hash: str) -> str
+# def load_thumbnail(image_hash: str, image_path: str | None = None) -> bytes | None
+# def persist_image(file_path: str, image_data: bytes) -> None
+# def persist_thumbnail(image_hash: str, image_data: bytes) -> None
+# def flush_persisted_images() -> None
+# def delete_image_files(image_hash: str, file_path: str | None = None) -> None
+# def collect_orphaned_blobs(grace_seconds: int = BLOB_GC_GRACE) -> int
+# def start_blob_gc() -> None
+
+
+def upload_settings():
+    """Describe how clients should prepare uploads (advertised by the upload_settings request)"""
+    formats = ['jpeg', 'png'] + (['webp'] if WEBP_SUPPORTED else [])
+    return {"max_edge": UPLOAD_MAX_EDGE, "formats": formats}
+
+
+def detect_image_type(image_data):
+    """Identify a JPEG, PNG or WebP upload from its magic bytes"""
+    for image_type, signature in IMAGE_SIGNATURES.items():
+        if image_data[:len(signature)] == signature:
+            return image_type
+    # WebP is a RIFF container: "RIFF", 4 size bytes, then "WEBP"
+    if WEBP_SUPPORTED and image_data[:4] == b'RIFF' and image_data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def decode_image(image_data):
+    """Decode an in-memory upload into a PIL image, raising ValueError if it is not a JPEG, PNG
+    or WebP or its pixel data is truncated or corrupt"""
+    try:
+        image = Image.open(io.BytesIO(image_data))
+    except Exception as e:
+        raise ValueError(f"Unreadable image: {e}")
+    if image.format not in ('JPEG', 'PNG', 'WEBP'):
+        raise ValueError(f"Unsupported image format: {image.format}")
+    # open() only parses the header; decode the pixels now so a corrupt upload fails here
+    # instead of inside a batch shared with other requests
+    try:
+        image.load()
+    except Exception as e:
+        raise ValueError(f"Unreadable image: {e}")
+    return image
+
+
+def make_thumbnail(image_data):
+    """Encode a small WebP (or JPEG) preview of an image"""
+    image = Image.open(io.BytesIO(image_data))
+    # Lets the JPEG decoder scale down while decoding instead of decoding full size first
+    image.draft('RGB', THUMBNAIL_SIZE)
+    image = image.convert('RGB')
+    image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return output.getvalue()
+
+
+def perceptual_hash(image_data):
+    """Compute a 64-bit difference hash (dHash) that stays stable across re-photographs of the same scene"""
+    image = Image.open(io.BytesIO(image_data))
+    image.draft('L', (64, 64))
+    # 9x8 grayscale: each bit says whether a pixel is brighter than its right-hand neighbour
+    pixels = list(image.convert('L').resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def shard_path(directory, image_hash, extension):
+    """Two levels of hex sharding: ab/cd/abcd...<ext>"""
+    return os.path.join(directory, image_hash[:2], image_hash[2:4], f"{image_hash}.{extension}")
+
+
+def blob_path(image_hash, image_type):
+    """Where an upload of a detected type is stored"""
+    return shard_path(IMAGE_DIR, image_hash, IMAGE_TYPES[image_type][0])
+
+
+def thumbnail_path(image_hash):
+    return shard_path(THUMBNAIL_DIR, image_hash, THUMBNAIL_EXTENSION)
+
+
+def _legacy_thumbnail_path(image_hash):
+    # Thumbnails written before sharding sit directly in THUMBNAIL_DIR
+    return os.path.join(THUMBNAIL_DIR, f"{image_hash}.{THUMBNAIL_EXTENSION}")
+
+
+def load_thumbnail(image_hash, image_path=None):
+    """Return the stored thumbnail for an image, generating it from the original if it is missing"""
+    path = thumbnail_path(image_hash)
+    for candidate in (path, _legacy_thumbnail_path(image_hash)):
+        if os.path.exists(candidate):
+            with open(candidate, 'rb') as f:
+                return f.read()
+
+    # Backfill images that were ingested before thumbnails existed
+    if image_path and os.path.exists(image_path):
+        with open(image_path, 'rb') as f:
+            thumbnail = make_thumbnail(f.read())
+        _write_file(path, thumbnail)
+        return thumbnail
+    return None
+
+
+def _write_file(file_path, data):
+    if os.path.exists(file_path):
+        return
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, file_path)
+
+
+def _write_thumbnail(image_hash, image_data):
+    path = thumbnail_path(image_hash)
+    if not os.path.exists(path) and not os.path.exists(_legacy_thumbnail_path(image_hash)):
+        _write_file(path, make_thumbnail(image_data))
+
+
+def _writer_loop():
+    while True:
+        write, target, data = write_queue.get()
+        try:
+            write(target, data)
+        except Exception as e:
+            log_event("persist_failed", level="error", target=target, error=str(e))
+        finally:
+            write_queue.task_done()
+
+
+write_queue = queue.Queue(maxsize=PERSIST_QUEUE_SIZE)
+PERSIST_QUEUE_DEPTH.set_function(write_queue.qsize)
+os.makedirs(IMAGE_DIR, exist_ok=True)
+os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+writer_thread = None
+writer_lock = threading.Lock()
+# Held while an upload reuses a stored file and while the blob collector checks and deletes one,
+# so a re-uploaded image is never deleted between the two
+blob_lock = threading.Lock()
+
+
+def _enqueue_write(write, target, data):
+    global writer_thread
+    with writer_lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=_writer_loop, name="image-writer", daemon=True)
+            writer_thread.start()
+    # Blocks when the writer falls behind so memory use stays bounded
+    write_queue.put((write, target, data))
+
+
+def _reuse_file(path):
+    """Touch a stored file so the blob collector keeps it; returns False if there is none"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _modified_since(cutoff, *paths):
+    for path in paths:
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                return True
+        except (OSError, TypeError):
+            pass
+    return False
+
+
+def persist_image(file_path, image_data):
+    """Queue an upload to be written to disk off the response path. A stored image is not
+    rewritten, only touched: its new image_cache row is still queued, and until it is written
+    the blob collector would otherwise see the image as unreferenced."""
+    if not PERSIST_UPLOADS:
+        return
+    with blob_lock:
+        stored = _reuse_file(file_path)
+    if not stored:
+        _enqueue_write(_write_file, file_path, image_data)
+
+
+def persist_thumbnail(image_hash, image_data):
+    """Queue thumbnail generation for a newly ingested image; an existing thumbnail is touched"""
+    with blob_lock:
+        stored = _reuse_file(thumbnail_path(image_hash)) or _reuse_file(_legacy_thumbnail_path(image_hash))
+    if not stored:
+        _enqueue_write(_write_thumbnail, image_hash, image_data)
+
+
+def flush_persisted_images():
+    """Wait until every queued image has been written"""
+    if writer_thread is not None:
+        write_queue.join()
+
+
+def delete_image_files(image_hash, file_path=None):
+    """Remove a stored image with its thumbnail and model embeddings"""
+    paths = {file_path} if file_path else set()
+    paths.update(blob_path(image_hash, image_type) for image_type in IMAGE_TYPES)
+    paths.update((thumbnail_path(image_hash), _legacy_thumbnail_path(image_hash),
+                  os.path.join(EMBEDDING_DIR, f"{image_hash}.npy")))
+    # One embedding per model revision, device and precision that has seen the image
+    paths.update(glob.glob(os.path.join(EMBEDDING_DIR, '*', f"{image_hash}.npy")))
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _shard_dirs(directory):
+    for first in sorted(os.listdir(directory)):
+        if SHARD_NAME.match(first):
+            for second in sorted(os.listdir(os.path.join(directory, first))):
+                if SHARD_NAME.match(second):
+                    yield os.path.join(directory, first, second)
+
+
+def collect_orphaned_blobs(grace_seconds=BLOB_GC_GRACE):
+    """Delete stored images that no image_cache row references; returns how many were removed"""
+    cutoff = int(time.time()) - grace_seconds
+    removed = 0
+
+    # Images whose last image_cache row has been deleted
+    while True:
+        blobs = get_unreferenced_blobs(cutoff, BLOB_GC_BATCH)
+        for image_hash, file_path in blobs:
+            with blob_lock:
+                # Skipped if an upload reused the image within the grace period, even though
+                # its image_cache row may still be waiting in the write-behind queue
+                if _modified_since(cutoff, file_path, thumbnail_path(image_hash)):
+                    continue
+                # Skipped if an upload referenced the image again since the query
+                if not delete_blob_record(image_hash):
+                    continue
+                delete_image_files(image_hash, file_path)
+            removed += 1
+        if len(blobs) < BLOB_GC_BATCH:
+            break
+
+    # Files that never got a row, e.g. when the server stopped before committing it
+    for shard in _shard_dirs(IMAGE_DIR):
+        files = {}
+        for name in os.listdir(shard):
+            files.setdefault(name.split('.')[0], []).append(os.path.join(shard, name))
+        known = get_known_blobs(list(files))
+        for image_hash, paths in files.items():
+            if image_hash in known:
+                continue
+            try:
+                if all(os.path.getmtime(path) < cutoff for path in paths):
+                    delete_image_files(image_hash)
+                    # Anything left over, such as the temporary file of an interrupted write
+                    for path in paths:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    removed += 1
+            except OSError as e:
+                log_event("blob_gc_failed", level="warning", image_hash=image_hash[:12], error=str(e))
+
+    BLOBS_COLLECTED.inc(removed)
+    return removed
+
+
+def _blob_gc_loop():
+    while True:
+        time.sleep(BLOB_GC_INTERVAL)
+        try:
+            started = time.perf_counter()
+            removed = collect_orphaned_blobs()
+            log_event("blob_gc_finished", removed=removed, seconds=round(time.perf_counter() - started, 3))
+        except Exception as e:
+            log_event("blob_gc_failed", level="error", error=str(e))
+
+
+def start_blob_gc():
+    """Collect orphaned images every BLOB_GC_INTERVAL seconds in a background thread"""
+    if BLOB_GC_INTERVAL > 0:
+        threading.Thread(target=_blob_gc_loop, name="blob-gc", daemon=True).start()
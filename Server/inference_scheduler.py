@@ -0,0 +1,209 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dotenv import load_dotenv
+from metrics_utils import INFERENCE_BATCH_SECONDS, INFERENCE_BATCH_SIZE, INFERENCE_QUEUE_DEPTH
+from trace_utils import log_event, record_span
+from worker_pool import INFERENCE_PROCESSES, ModelNotReadyError, ModelWorkerPool
+
+load_dotenv()
+
+# Micro-batching configuration
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 4))
+MAX_BATCH_WAIT_MS = int(os.getenv("MAX_BATCH_WAIT_MS", 25))
+# Seconds an image request waits for a model that is still loading
+MODEL_READY_TIMEOUT = float(os.getenv("MODEL_READY_TIMEOUT", 10))
+
+# Function declarations:
+# class InferenceScheduler(run_batch: callable, max_batch_size: int, max_wait_ms: int, num_workers: int)
+# def start_model_loading() -> None
+# def model_status() -> str
+# def wait_for_model(timeout: float = MODEL_READY_TIMEOUT) -> bool
+# def query_ai(image: Image.Image, prompt: str, image_hash: str) -> str
+# def stop_model() -> None
+
+
+class InferenceScheduler:
+    """Inference worker threads that group queued requests into batches"""
+
+    def __init__(self, run_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS, num_workers=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.num_workers = max(1, num_workers)
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, *request):
+        """Queue a request and return a Future that resolves to its result"""
+        self._ensure_worker()
+        future = Future()
+        future.submitted_at = time.perf_counter()
+        self._queue.put((request, future))
+        return future
+
+    def queue_depth(self):
+        """Number of requests waiting for a worker"""
+        return self._queue.qsize()
+
+    def shutdown(self):
+        """Stop the workers once the requests already queued are done"""
+        with self._lock:
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join(timeout=5.0)
+            self._workers = []
+
+    def _ensure_worker(self):
+        with self._lock:
+            if not self._workers:
+                for i in range(self.num_workers):
+                    worker = threading.Thread(target=self._run, name=f"inference-worker-{i}", daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+
+    def _collect_batch(self, first):
+        """Gather up to max_batch_size requests, waiting at most max_wait after the first one"""
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back so the worker exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+
+            batch = [(request, future) for request, future in self._collect_batch(first)
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            INFERENCE_BATCH_SIZE.observe(len(batch))
+            started = time.perf_counter()
+            try:
+                results = self.run_batch([request for request, _ in batch])
+            except Exception as e:
+                log_event("inference_batch_failed", level="error", batch_size=len(batch), error=str(e))
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            INFERENCE_BATCH_SECONDS.observe(finished - started)
+
+            # Lets each caller split its wait into queueing and model time
+            for (_, future), result in zip(batch, results):
+                future.batch_started, future.batch_finished, future.batch_size = started, finished, len(batch)
+                future.set_result(result)
+
+
+def _run_batch(requests):
+    if worker_pool is not None:
+        return worker_pool.run_batch(requests)
+    import vegsecai_model
+    return vegsecai_model.batch_query_ai(requests)
+
+
+# With INFERENCE_PROCESSES set, batches run in separate model processes so inference
+# neither shares the GIL with the socket threads nor takes the server down if it crashes
+worker_pool = ModelWorkerPool(INFERENCE_PROCESSES) if INFERENCE_PROCESSES > 0 else None
+
+# Shared by every handle_client thread: in-process forward passes never run in parallel,
+# and with a worker pool each process gets one batch at a time
+scheduler = InferenceScheduler(_run_batch, num_workers=INFERENCE_PROCESSES or 1)
+INFERENCE_QUEUE_DEPTH.set_function(scheduler.queue_depth)
+
+# Model readiness: the model loads in a background thread so the server can accept
+# logins and history requests while it warms up
+model_ready = threading.Event()
+model_load_error = None
+loader_thread = None
+loader_lock = threading.Lock()
+
+
+def _load_model():
+    global model_load_error
+    started = time.time()
+    if worker_pool is not None:
+        worker_pool.start()
+        if not worker_pool.wait_ready():
+            model_load_error = worker_pool.load_error
+            log_event("model_load_failed", level="error", error=str(model_load_error))
+            return
+        model_ready.set()
+        log_event("model_ready", seconds=round(time.time() - started, 1), worker_processes=INFERENCE_PROCESSES)
+        return
+
+    try:
+        # Importing torch/transformers is itself slow, so it happens here rather than at startup
+        import vegsecai_model
+        vegsecai_model.load_model()
+    except Exception as e:
+        model_load_error = e
+        log_event("model_load_failed", level="error", error=str(e))
+        return
+    model_ready.set()
+    log_event("model_ready", seconds=round(time.time() - started, 1))
+
+
+def start_model_loading():
+    """Begin loading the model in the background (only the first call has an effect)"""
+    global loader_thread
+    with loader_lock:
+        if loader_thread is None:
+            log_event("model_loading")
+            loader_thread = threading.Thread(target=_load_model, name="model-loader", daemon=True)
+            loader_thread.start()
+
+
+def model_status():
+    if model_ready.is_set():
+        return "ready"
+    if model_load_error is not None:
+        return "failed"
+    return "loading" if loader_thread is not None else "not started"
+
+
+def wait_for_model(timeout=MODEL_READY_TIMEOUT):
+    """Wait up to timeout seconds for the model, returning whether it is ready"""
+    start_model_loading()
+    if model_load_error is not None:
+        return False
+    return model_ready.wait(timeout)
+
+
+def query_ai(image, prompt, image_hash):
+    """Run a model query through the shared batching scheduler and wait for the answer"""
+    if not wait_for_model():
+        if model_load_error is not None:
+            raise ModelNotReadyError(f"The AI model is unavailable: {model_load_error}")
+        raise ModelNotReadyError("The AI model is still warming up. Please try again in a moment.")
+    future = scheduler.submit(image, prompt, image_hash)
+    answer = future.result()
+    record_span("inference_queue", future.submitted_at, future.batch_started)
+    record_span("inference_batch", future.batch_started, future.batch_finished, batch_size=future.batch_size)
+    return answer
+
+
+def stop_model():
+    """Stop the inference workers and any model processes"""
+    scheduler.shutdown()
+    if worker_pool is not None:
+        worker_pool.shutdown()
@@ -0,0 +1,319 @@
+"""Load test for the VegSecAI server with a stubbed model.
+
+Starts the server in a subprocess inside a scratch directory (its own database, images and
+certificate), replaces the model with a fixed fake latency, and drives N concurrent TLS clients
+through login, image uploads and a history fetch. Latency percentiles, throughput and errors
+are printed and written to a JSON file so runs can be compared across changes.
+
+Usage: python load_test.py --clients 20 --requests 10 --model-latency 200 --output results.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import bcrypt
+from protocol import (
+    FRAME_TEXT, FRAME_IMAGE, FRAME_BYE, FRAME_END, FRAME_ERROR,
+    recv_frame, recv_text, send_frame, send_frames, send_texts
+)
+from stats_utils import summarize
+
+DEFAULT_PORT = 12479
+LOAD_TEST_PASSWORD = "load-test-password"
+OPERATIONS = ("connect", "login", "upload", "history")
+
+# Function declarations:
+# def make_png(width: int, height: int, seed: int) -> bytes
+# def serve_stubbed(args) -> None
+# def create_users(work_dir: str, count: int) -> None
+# def wait_for_port(host: str, port: int, timeout: float) -> bool
+# def run_client(index: int, args, stats: LoadStats) -> None
+# def fetch_history(args, stats: LoadStats, session_token: str) -> None
+# def run_load_test(args) -> dict
+# def main() -> None
+
+
+class LoadStats:
+    """Latency samples and error counts collected from every client thread"""
+
+    def __init__(self):
+        self.samples = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.error_messages = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds):
+        with self._lock:
+            self.samples[operation].append(seconds)
+
+    def error(self, operation, error):
+        with self._lock:
+            self.errors[operation] += 1
+            message = f"{operation}: {type(error).__name__}: {error}"
+            self.error_messages[message] = self.error_messages.get(message, 0) + 1
+
+
+def make_png(width, height, seed):
+    """Encode a small solid-colour PNG; the seed makes every upload unique so nothing is served from cache"""
+    rng = random.Random(seed)
+    pixel = bytes(rng.randrange(256) for _ in range(3))
+    raw = b''.join(b'\x00' + pixel * width for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack("!I", len(data)) + kind + data + struct.pack("!I", zlib.crc32(kind + data))
+
+    header = struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'tEXt', f"seed\x00{seed}".encode())
+            + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b''))
+
+
+def serve_stubbed(args):
+    """Child process: run the real server with the model replaced by a fixed delay"""
+    import inference_scheduler
+
+    def fake_batch(requests):
+        time.sleep((args.model_latency + args.per_image_latency * len(requests)) / 1000)
+        return ["This looks like a carrot (load test)." for _ in requests]
+
+    # Requests still go through the batching scheduler; only the forward pass is faked
+    inference_scheduler.scheduler.run_batch = fake_batch
+    inference_scheduler.model_ready.set()
+    inference_scheduler.start_model_loading = lambda: None
+
+    if args.server_mode == "asyncio":
+        import async_server
+        async_server.start_model_loading = lambda: None
+        async_server.start_async_server("127.0.0.1", args.port)
+    else:
+        import run_server
+        run_server.start_model_loading = lambda: None
+        run_server.HOST = "127.0.0.1"
+        run_server.PORT = args.port
+        run_server.MAX_THREADS = args.max_threads
+        run_server.semaphore = threading.Semaphore(args.max_threads)
+        run_server.start_server()
+
+
+def create_users(work_dir, count):
+    """Create verified load-test accounts (one per client, so the login rate limit is per account)"""
+    import db_utils
+    db_utils.DATABASE = os.path.join(work_dir, "user_data.db")
+    db_utils.init_db()
+    password_hash = bcrypt.hashpw(LOAD_TEST_PASSWORD.encode(), bcrypt.gensalt()).decode()
+    for i in range(count):
+        db_utils.save_user(f"loadtest{i}", password_hash, f"loadtest{i}@example.invalid", verified=1)
+
+
+def wait_for_port(host, port, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def _connect(port, stats):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    started = time.perf_counter()
+    sock = context.wrap_socket(socket.create_connection(("127.0.0.1", port), timeout=60))
+    stats.record("connect", time.perf_counter() - started)
+    return sock
+
+
+def run_client(index, args, stats):
+    """One simulated user: log in, upload images (pipelined up to --window) and fetch history"""
+    username = f"loadtest{index}"
+    try:
+        sock = _connect(args.port, stats)
+    except Exception as e:
+        stats.error("connect", e)
+        return
+
+    operation = "login"
+    try:
+        started = time.perf_counter()
+        send_texts(sock, ["login", username, LOAD_TEST_PASSWORD])
+        response = recv_text(sock)
+        if response != "Login successful":
+            raise RuntimeError(response)
+        session_token = recv_text(sock)
+        stats.record("login", time.perf_counter() - started)
+
+        operation = "upload"
+        sent_at = {}  # request id -> send time
+        next_request = 0
+        while next_request < args.requests or sent_at:
+            while next_request < args.requests and len(sent_at) < args.window:
+                image_data = make_png(args.image_size, args.image_size, index * 1_000_000 + next_request)
+                request_id = next_request + 1
+                next_request += 1
+                sent_at[request_id] = time.perf_counter()
+                send_frames(sock, [
+                    (FRAME_IMAGE, image_data, request_id),
+                    (FRAME_TEXT, hashlib.sha256(image_data).hexdigest().encode(), request_id),
+                    (FRAME_TEXT, b"What vegetable is this?", request_id),
+                ])
+
+            frame = recv_frame(sock)
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            frame_type, request_id, payload = frame
+            started = sent_at.pop(request_id, None)
+            if frame_type == FRAME_ERROR:
+                stats.error("upload", RuntimeError(payload.decode()))
+            elif started is not None:
+                stats.record("upload", time.perf_counter() - started)
+
+        # The session token is only valid while the login connection is open
+        fetch_history(args, stats, session_token)
+        send_frame(sock, FRAME_BYE)
+    except Exception as e:
+        stats.error(operation, e)
+    finally:
+        sock.close()
+
+
+def fetch_history(args, stats, session_token):
+    """Fetch the first history page over a second connection, as the GUI does"""
+    try:
+        sock = _connect(args.port, stats)
+    except Exception as e:
+        stats.error("connect", e)
+        return
+    try:
+        started = time.perf_counter()
+        send_texts(sock, ["get_history", session_token, "", "50"])
+        while True:
+            frame = recv_frame(sock)
+            if frame is None:
+                raise ConnectionError("Server closed the connection before the end of the history page")
+            if frame[0] == FRAME_END:
+                break
+            if frame[0] == FRAME_ERROR:
+                raise RuntimeError(frame[2].decode())
+        stats.record("history", time.perf_counter() - started)
+    except Exception as e:
+        stats.error("history", e)
+    finally:
+        sock.close()
+
+
+def run_load_test(args):
+    work_dir = tempfile.mkdtemp(prefix="vegsecai-load-")
+    create_users(work_dir, args.clients)
+
+    log_path = os.path.join(work_dir, "server.log")
+    command = [
+        sys.executable, os.path.abspath(__file__), "--serve", "--port", str(args.port),
+        "--server-mode", args.server_mode, "--max-threads", str(args.max_threads),
+        "--model-latency", str(args.model_latency), "--per-image-latency", str(args.per_image_latency),
+    ]
+    with open(log_path, "w") as log:
+        server = subprocess.Popen(command, cwd=work_dir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        if not wait_for_port("127.0.0.1", args.port, timeout=30):
+            raise RuntimeError(f"Server did not start; see {log_path}")
+
+        stats = LoadStats()
+        threads = [threading.Thread(target=run_client, args=(i, args, stats), daemon=True)
+                   for i in range(args.clients)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if os.name == "posix":
+            server.send_signal(signal.SIGINT)
+        else:
+            server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        if args.keep_temp:
+            print(f"Scratch directory kept at {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    uploads = len(stats.samples["upload"])
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {
+            "server_mode": args.server_mode,
+            "clients": args.clients,
+            "requests_per_client": args.requests,
+            "window": args.window,
+            "max_threads": args.max_threads,
+            "model_latency_ms": args.model_latency,
+            "per_image_latency_ms": args.per_image_latency,
+            "image_size": args.image_size,
+        },
+        "elapsed_seconds": elapsed,
+        "uploads_per_second": uploads / elapsed if elapsed else 0.0,
+        "operations": {operation: summarize(stats.samples[operation]) for operation in OPERATIONS},
+        "errors": stats.errors,
+        "connection_errors": stats.errors["connect"],
+        "error_messages": stats.error_messages,
+    }
+
+
+def _print_report(report):
+    print(f"{'operation':<10}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for operation, summary in report["operations"].items():
+        values = [summary[key] for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms")]
+        cells = "".join(f"{value:>10.1f}" if value is not None else f"{'-':>10}" for value in values)
+        print(f"{operation:<10}{summary['count']:>8}{cells}{report['errors'][operation]:>8}")
+    print(f"Elapsed {report['elapsed_seconds']:.2f} s, {report['uploads_per_second']:.1f} uploads/s, "
+          f"{report['connection_errors']} connection errors")
+    for message, count in report["error_messages"].items():
+        print(f"  {count} x {message}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the VegSecAI server with a stubbed model")
+    parser.add_argument("--clients", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--requests", type=int, default=10, help="image uploads per client")
+    parser.add_argument("--window", type=int, default=1, help="uploads each client pipelines")
+    parser.add_argument("--model-latency", type=float, default=200, help="fake forward pass time per batch (ms)")
+    parser.add_argument("--per-image-latency", type=float, default=0, help="extra fake time per image in a batch (ms)")
+    parser.add_argument("--max-threads", type=int, default=5, help="threaded server connection limit")
+    parser.add_argument("--server-mode", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--image-size", type=int, default=256, help="edge of the generated test images (px)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--keep-temp", action="store_true", help="keep the scratch directory and server log")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_stubbed(args)
+        return
+
+    report = run_load_test(args)
+    _print_report(report)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""Prometheus-style metrics served as text over a local HTTP port.
+
+    curl http://127.0.0.1:9108/metrics
+
+Other modules can serve local admin commands from the same port with add_endpoint.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Metrics endpoint; bound to localhost only, set METRICS_PORT=0 to disable it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+
+# Seconds; spans a cache hit (sub-millisecond) to a slow CPU forward pass
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Function declarations:
+# class Counter(name: str, documentation: str, labelnames: tuple = ())
+# class Gauge(name: str, documentation: str, labelnames: tuple = ())
+# class Histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS)
+# def render_metrics() -> str
+# def add_endpoint(path: str, function: callable) -> None
+# def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT) -> ThreadingHTTPServer | None
+
+registry = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Report function() at scrape time instead of a stored value"""
+        self._function = function
+
+    def render(self):
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception:
+                pass
+        return super().render()
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the running sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+# Connections and handler saturation
+CONNECTIONS_TOTAL = Counter("vegsecai_connections_total", "Client connections accepted")
+ACTIVE_HANDLERS = Gauge("vegsecai_active_handlers", "Connections currently being served")
+WAITING_HANDLERS = Gauge("vegsecai_waiting_handlers", "Connections waiting for a free handler slot")
+MAX_HANDLERS = Gauge("vegsecai_max_handlers", "Configured limit on concurrently served connections")
+SEMAPHORE_WAIT_SECONDS = Histogram("vegsecai_semaphore_wait_seconds", "Time a connection waited for a handler slot")
+REQUESTS_TOTAL = Counter("vegsecai_requests_total", "Requests by type", ("type",))
+
+# Image pipeline
+BYTES_RECEIVED = Counter("vegsecai_upload_bytes_received_total", "Image bytes received from clients")
+IMAGE_DECODE_SECONDS = Histogram("vegsecai_image_decode_seconds", "Time to validate and open an upload")
+INFERENCE_SECONDS = Histogram("vegsecai_inference_seconds", "Time from submitting a query to receiving its answer")
+INFERENCE_BATCH_SECONDS = Histogram("vegsecai_inference_batch_seconds", "Model time per batch, excluding queueing")
+INFERENCE_QUEUE_DEPTH = Gauge("vegsecai_inference_queue_depth", "Queries waiting for the inference worker")
+INFERENCE_BATCH_SIZE = Histogram("vegsecai_inference_batch_size", "Queries per model batch",
+                                 buckets=(1, 2, 4, 8, 16, 32))
+CACHE_WRITE_QUEUE_DEPTH = Gauge("vegsecai_cache_write_queue_depth", "image_cache rows waiting to be committed")
+PERSIST_QUEUE_DEPTH = Gauge("vegsecai_persist_queue_depth", "Image and thumbnail writes waiting for the writer")
+BLOBS_COLLECTED = Counter("vegsecai_blobs_collected_total", "Stored images deleted by the garbage collector")
+CACHE_LOOKUPS = Counter("vegsecai_answer_cache_lookups_total",
+                        "Uploads by answer cache outcome: hit, near_duplicate or miss", ("result",))
+
+# Storage and email
+DB_QUERY_SECONDS = Histogram("vegsecai_db_query_seconds", "SQLite statement execution time", ("statement",))
+RETENTION_ROWS_DELETED = Counter("vegsecai_retention_rows_deleted_total",
+                                 "image_cache rows deleted by retention, by policy", ("policy",))
+EMAILS_TOTAL = Counter("vegsecai_emails_total", "Emails sent, by outcome", ("result",))
+
+
+def render_metrics():
+    """Render every registered metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Paths served by the metrics port; each maps to function(query) -> (status, text body)
+endpoints = {"/metrics": lambda query: (200, render_metrics())}
+
+
+def add_endpoint(path, function):
+    """Serve GET path from the metrics port, e.g. a local admin command"""
+    endpoints[path] = function
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        function = endpoints.get(url.path)
+        if function is None:
+            self.send_error(404)
+            return
+        try:
+            status, text = function({key: values[-1] for key, values in parse_qs(url.query).items()})
+        except Exception as e:
+            status, text = 500, f"{type(e).__name__}: {e}\n"
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the server log
+        pass
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /metrics from a background thread; returns None when disabled or the port is taken"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"[Server] Metrics endpoint disabled: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"[Server] Metrics available at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,171 @@
+"""Micro-benchmark of the model path with per-stage timing.
+
+Runs the accuracy set (see accuracy_check.py for the manifest format) through the three stages
+of a query — Image.open/decode, encode_image and answer_question — and reports per-stage
+latency, model load time, peak RSS and torch thread settings. Each precision/device mode runs
+in its own process so memory peaks and thread settings do not leak between modes.
+
+Usage: python model_benchmark.py --modes fp32:cpu,bf16:cpu,int8:cpu --repeat 3 --output benchmark.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from accuracy_check import ACCURACY_SET_DIR, load_accuracy_set
+from stats_utils import peak_rss_mb, summarize
+
+STAGES = ("open", "encode", "answer", "total")
+
+# Function declarations:
+# def benchmark_mode(samples: list[dict], precision_mode: str, device_name: str, repeat: int, warmup: int) -> dict
+# def run_mode_subprocess(mode: str, args) -> dict
+# def main() -> int
+
+
+def benchmark_mode(samples, precision_mode, device_name, repeat, warmup):
+    """Load the model in one mode and time every stage over the corpus"""
+    import torch
+    from PIL import Image
+    import vegsecai_model
+
+    started = time.perf_counter()
+    vegsecai_model.load_model(precision_mode, device_name)
+    load_seconds = time.perf_counter() - started
+    model = vegsecai_model.moondream
+
+    def synchronize():
+        # CUDA runs asynchronously; wait for queued kernels so they count towards their stage
+        if vegsecai_model.device is not None and torch.device(vegsecai_model.device).type == 'cuda':
+            torch.cuda.synchronize()
+
+    timings = {stage: [] for stage in STAGES}
+    for iteration in range(warmup + repeat):
+        for sample in samples:
+            stage_started = time.perf_counter()
+            image = Image.open(sample["path"])
+            image.load()
+            opened = time.perf_counter()
+
+            # Calls the model directly so the embedding cache never short-circuits a stage
+            with torch.no_grad():
+                image_embeds = model.encode_image(image)
+            synchronize()
+            encoded = time.perf_counter()
+
+            model.answer_question(image_embeds, sample["question"], vegsecai_model.tokenizer)
+            synchronize()
+            answered = time.perf_counter()
+
+            if iteration >= warmup:
+                timings["open"].append(opened - stage_started)
+                timings["encode"].append(encoded - opened)
+                timings["answer"].append(answered - encoded)
+                timings["total"].append(answered - stage_started)
+
+    result = {
+        "precision": vegsecai_model.precision,
+        "device": str(vegsecai_model.device),
+        "dtype": str(vegsecai_model.dtype),
+        "load_seconds": load_seconds,
+        "stages": {stage: summarize(values) for stage, values in timings.items()},
+        "peak_rss_mb": peak_rss_mb(),
+        "torch_threads": {
+            "intra_op": torch.get_num_threads(),
+            "inter_op": torch.get_num_interop_threads(),
+            "OMP_NUM_THREADS": os.getenv("OMP_NUM_THREADS"),
+            "MKL_NUM_THREADS": os.getenv("MKL_NUM_THREADS"),
+        },
+    }
+    if torch.cuda.is_available():
+        result["cuda_peak_memory_mb"] = torch.cuda.max_memory_allocated() / (1024 * 1024)
+    return result
+
+
+def run_mode_subprocess(mode, args):
+    """Benchmark one precision:device mode in a fresh interpreter"""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    command = [
+        sys.executable, os.path.abspath(__file__), "--run-mode", mode, "--result-file", result_path,
+        "--set-dir", args.set_dir, "--repeat", str(args.repeat), "--warmup", str(args.warmup),
+    ]
+    try:
+        completed = subprocess.run(command)
+        if completed.returncode != 0:
+            return {"mode": mode, "error": f"benchmark process exited with code {completed.returncode}"}
+        with open(result_path) as f:
+            return json.load(f)
+    finally:
+        os.remove(result_path)
+
+
+def _system_info():
+    info = {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        import torch
+        from moondream.hf import LATEST_REVISION
+        info["torch"] = torch.__version__
+        info["model_revision"] = LATEST_REVISION
+    except ImportError:
+        pass
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the model path stage by stage")
+    parser.add_argument("--modes", default="fp32:auto",
+                        help="comma-separated precision:device pairs, e.g. fp32:cpu,int8:cpu,auto:cuda")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes over the corpus")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed passes before measuring")
+    parser.add_argument("--set-dir", default=ACCURACY_SET_DIR)
+    parser.add_argument("--output", default="model_benchmark.json")
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    samples = load_accuracy_set(args.set_dir)
+
+    if args.run_mode:
+        precision_mode, _, device_name = args.run_mode.partition(":")
+        result = benchmark_mode(samples, precision_mode, device_name or "auto", args.repeat, args.warmup)
+        result["mode"] = args.run_mode
+        with open(args.result_file, "w") as f:
+            json.dump(result, f)
+        return 0
+
+    results = [run_mode_subprocess(mode.strip(), args) for mode in args.modes.split(",") if mode.strip()]
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "system": _system_info(),
+        "corpus": {"images": len(samples), "repeat": args.repeat, "warmup": args.warmup},
+        "results": results,
+    }
+
+    print(f"{'mode':<14}{'load s':>8}{'open ms':>10}{'encode ms':>11}{'answer ms':>11}{'total ms':>10}{'RSS MB':>9}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['mode']:<14}{result['error']}")
+            continue
+        stages = result["stages"]
+        rss = result["peak_rss_mb"]
+        print(f"{result['mode']:<14}{result['load_seconds']:>8.1f}{stages['open']['p50_ms']:>10.1f}"
+              f"{stages['encode']['p50_ms']:>11.1f}{stages['answer']['p50_ms']:>11.1f}"
+              f"{stages['total']['p50_ms']:>10.1f}{rss if rss is not None else float('nan'):>9.0f}")
+    print("(stage columns are medians)")
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 1 if any("error" in result for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
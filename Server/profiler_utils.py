@@ -0,0 +1,136 @@
+"""On-demand wall-clock sampling profiler for the running server.
+
+Nothing is sampled until a profile is requested, either with a signal
+
+    kill -USR1 <server pid>                                  # PROFILE_SECONDS, written to PROFILE_DIR
+
+or from the local metrics port, which also returns the result:
+
+    curl "http://127.0.0.1:9108/profile?seconds=20" > server.collapsed
+
+Every thread's stack is sampled, including threads that are waiting (for the handler
+semaphore, a SQLite lock, a model batch or a socket), so the profile shows where wall-clock
+time goes rather than only CPU time. Time inside C code such as SQLite or torch kernels is
+attributed to the Python frame that called it. The output is in the collapsed-stack format
+read by flamegraph.pl and speedscope: one "thread;outer;...;inner count" line per stack.
+"""
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from dotenv import load_dotenv
+from metrics_utils import add_endpoint
+from trace_utils import log_event
+
+load_dotenv()
+
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", 30))  # default length of a profile
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 10))  # 100 samples per second
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Function declarations:
+# def sample_stacks(seconds: float, interval: float) -> tuple[Counter, int]
+# def format_collapsed(stacks: Counter) -> str
+# def run_profile(seconds: float = PROFILE_SECONDS, interval_ms: float = PROFILE_INTERVAL_MS) -> tuple[str, str]
+# def start_profile(seconds: float = PROFILE_SECONDS) -> None
+# def install_profile_signal() -> None
+
+profile_lock = threading.Lock()
+
+
+class ProfileRunningError(Exception):
+    """Raised when a profile is requested while another one is still sampling"""
+
+
+def _thread_label(name):
+    # "image_3" and "Thread-12 (handle_client)" become "image" and "Thread (handle_client)" so
+    # the threads of one pool merge into a single flame graph root
+    return re.sub(r"[-_]?\d+", "", name) or name
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds, interval):
+    """Sample every other thread's stack for seconds; returns (stack counts, number of samples)"""
+    stacks = Counter()
+    own_ident = threading.get_ident()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(_thread_label(names.get(ident, "unknown")))
+            stacks[";".join(reversed(labels))] += 1
+        samples += 1
+        time.sleep(interval)
+    return stacks, samples
+
+
+def format_collapsed(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(stacks.items()))
+
+
+def run_profile(seconds=PROFILE_SECONDS, interval_ms=PROFILE_INTERVAL_MS):
+    """Profile for seconds and write the collapsed stacks to PROFILE_DIR; returns (path, text)"""
+    seconds = max(0.1, min(float(seconds), PROFILE_MAX_SECONDS))
+    interval = max(1.0, float(interval_ms)) / 1000
+    if not profile_lock.acquire(blocking=False):
+        raise ProfileRunningError("A profile is already running")
+    try:
+        log_event("profile_started", seconds=seconds, interval_ms=interval * 1000)
+        stacks, samples = sample_stacks(seconds, interval)
+    finally:
+        profile_lock.release()
+
+    text = format_collapsed(stacks)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.collapsed")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    log_event("profile_written", path=path, samples=samples, stacks=len(stacks))
+    return path, text
+
+
+def start_profile(seconds=PROFILE_SECONDS):
+    """Profile in a background thread; used where the caller must not block, such as a signal handler"""
+    def run():
+        try:
+            run_profile(seconds)
+        except ProfileRunningError as e:
+            log_event("profile_skipped", level="warning", reason=str(e))
+        except Exception as e:
+            log_event("profile_failed", level="error", error=str(e))
+
+    threading.Thread(target=run, name="profiler", daemon=True).start()
+
+
+def install_profile_signal():
+    """Start a profile on SIGUSR1 (not available on Windows); call from the main thread"""
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda sig, frame: start_profile())
+
+
+def _profile_endpoint(query):
+    try:
+        _, text = run_profile(query.get("seconds", PROFILE_SECONDS),
+                              query.get("interval_ms", PROFILE_INTERVAL_MS))
+    except ProfileRunningError as e:
+        return 409, f"{e}\n"
+    except ValueError as e:
+        return 400, f"Invalid parameter: {e}\n"
+    return 200, text
+
+
+add_endpoint("/profile", _profile_endpoint)
@@ -0,0 +1,213 @@
+"""Retention and compaction of the image history.
+
+Each limit below is off when set to 0. When a limit is exceeded, the oldest rows are deleted first.
+
+    RETENTION_MAX_AGE_DAYS     delete rows older than this
+    RETENTION_USER_MAX_ROWS    rows kept per user
+    RETENTION_USER_MAX_BYTES   bytes of stored images referenced by one user's history
+    RETENTION_MAX_ROWS         rows kept in total
+    RETENTION_MAX_BYTES        bytes of stored images referenced by any row
+
+A background thread applies the policies every RETENTION_INTERVAL seconds. It deletes in
+batches of RETENTION_BATCH_SIZE rows. Each batch is its own short transaction, with a pause
+in between, so queued history writes and logins are never held up for long. Cached answers
+for deleted rows are dropped. A deleted row releases its image through the image_blobs
+triggers. The blob collector in image_utils removes the image file, thumbnail and embedding
+once the image has been unreferenced for BLOB_GC_GRACE seconds. Freed database pages are
+then handed back to the filesystem a few at a time with incremental_vacuum.
+
+A database created before auto_vacuum was enabled needs one full VACUUM to switch over.
+That VACUUM blocks writers while it runs, so it is not done automatically. Run it while the
+server is stopped:
+
+    python retention_utils.py --vacuum
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+from cache_utils import forget_answers
+from db_utils import (
+    init_db, get_blobs_without_size, set_blob_size, get_image_cache_users, get_image_cache_user_counts,
+    get_image_cache_usage, delete_oldest_image_cache, get_vacuum_state, incremental_vacuum, vacuum
+)
+from metrics_utils import RETENTION_ROWS_DELETED
+from trace_utils import log_event
+
+load_dotenv()
+
+# Policies; 0 disables a limit
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", 0))
+RETENTION_USER_MAX_ROWS = int(os.getenv("RETENTION_USER_MAX_ROWS", 0))
+RETENTION_USER_MAX_BYTES = int(os.getenv("RETENTION_USER_MAX_BYTES", 0))
+RETENTION_MAX_ROWS = int(os.getenv("RETENTION_MAX_ROWS", 0))
+RETENTION_MAX_BYTES = int(os.getenv("RETENTION_MAX_BYTES", 0))
+
+# Background job
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 60 * 60))  # 0 disables the job
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 500))  # rows per delete transaction
+RETENTION_BATCH_PAUSE = 0.05  # seconds between batches, so other writers get the lock
+VACUUM_STEP_PAGES = 1024  # pages freed per incremental_vacuum step (4 MB with the default page size)
+
+# Function declarations:
+# def fill_blob_sizes() -> int
+# def run_retention() -> dict
+# def compact_database(full: bool = False) -> int
+# def start_retention() -> None
+# def main() -> int
+
+
+def _pause():
+    time.sleep(RETENTION_BATCH_PAUSE)
+
+
+def fill_blob_sizes():
+    """Record the size of images stored before sizes were tracked; returns how many were filled"""
+    filled = 0
+    while True:
+        blobs = get_blobs_without_size(RETENTION_BATCH_SIZE)
+        for image_hash, file_path in blobs:
+            try:
+                size = os.path.getsize(file_path)
+            except (OSError, TypeError):
+                size = 0  # file already gone; counting it as empty keeps it from being retried
+            set_blob_size(image_hash, size)
+        filled += len(blobs)
+        if len(blobs) < RETENTION_BATCH_SIZE:
+            return filled
+        _pause()
+
+
+def _purge(policy, limit, **where):
+    """Delete one batch of the oldest matching rows and forget their cached answers"""
+    rows = delete_oldest_image_cache(limit, **where)
+    forget_answers(rows)
+    RETENTION_ROWS_DELETED.inc(len(rows), policy=policy)
+    return len(rows)
+
+
+def _delete_rows(policy, count=None, **where):
+    """Delete the oldest rows matching where in batches, up to count rows (all matching if None)"""
+    deleted = 0
+    while count is None or deleted < count:
+        limit = RETENTION_BATCH_SIZE if count is None else min(RETENTION_BATCH_SIZE, count - deleted)
+        batch = _purge(policy, limit, **where)
+        deleted += batch
+        if batch < limit:
+            break
+        _pause()
+    return deleted
+
+
+def _delete_to_bytes(policy, max_bytes, username=None):
+    """Delete the oldest rows until the images they reference total at most max_bytes"""
+    deleted = 0
+    while True:
+        rows, used = get_image_cache_usage(username)
+        if used <= max_bytes or rows == 0:
+            return deleted
+        # Estimate the rows to drop from the average image size; the next loop corrects any shortfall
+        estimate = -(-rows * (used - max_bytes) // used)
+        batch = _purge(policy, min(RETENTION_BATCH_SIZE, max(1, estimate)), username=username)
+        if batch == 0:
+            return deleted
+        deleted += batch
+        _pause()
+
+
+def run_retention():
+    """Apply every enabled policy once; returns the rows deleted per policy"""
+    deleted = {}
+    if RETENTION_MAX_AGE_DAYS > 0:
+        before = int(time.time() - RETENTION_MAX_AGE_DAYS * 24 * 60 * 60)
+        deleted["age"] = _delete_rows("age", before=before)
+
+    if RETENTION_USER_MAX_ROWS > 0:
+        deleted["user_rows"] = sum(
+            _delete_rows("user_rows", rows - RETENTION_USER_MAX_ROWS, username=username)
+            for username, rows in get_image_cache_user_counts(RETENTION_USER_MAX_ROWS)
+        )
+
+    if RETENTION_USER_MAX_BYTES > 0 or RETENTION_MAX_BYTES > 0:
+        fill_blob_sizes()
+    if RETENTION_USER_MAX_BYTES > 0:
+        deleted["user_bytes"] = sum(
+            _delete_to_bytes("user_bytes", RETENTION_USER_MAX_BYTES, username)
+            for username in get_image_cache_users()
+        )
+
+    if RETENTION_MAX_ROWS > 0:
+        rows, _ = get_image_cache_usage()
+        deleted["rows"] = _delete_rows("rows", rows - RETENTION_MAX_ROWS) if rows > RETENTION_MAX_ROWS else 0
+
+    if RETENTION_MAX_BYTES > 0:
+        deleted["bytes"] = _delete_to_bytes("bytes", RETENTION_MAX_BYTES)
+    return deleted
+
+
+def compact_database(full=False):
+    """Return free database pages to the filesystem; returns the number of pages freed.
+    full runs VACUUM, which also switches a database to incremental auto_vacuum."""
+    mode, free_pages, _ = get_vacuum_state()
+    if full:
+        # Even with nothing to free, VACUUM is what switches a legacy database's auto_vacuum mode
+        if mode != 2 or free_pages > 0:
+            vacuum()
+        return free_pages - get_vacuum_state()[1]
+    if mode == 0:
+        log_event("vacuum_skipped", level="warning", free_pages=free_pages,
+                  reason="auto_vacuum is off; run 'python retention_utils.py --vacuum' while the server is stopped")
+        return 0
+    if mode != 2 or free_pages == 0:
+        # Full auto_vacuum already truncates the file on every commit
+        return 0
+
+    # Small steps keep each write lock short
+    remaining = free_pages
+    while remaining > 0:
+        incremental_vacuum(VACUUM_STEP_PAGES)
+        previous, remaining = remaining, get_vacuum_state()[1]
+        if remaining >= previous:
+            break
+        _pause()
+    return free_pages - remaining
+
+
+def _retention_loop():
+    while True:
+        time.sleep(RETENTION_INTERVAL)
+        try:
+            started = time.perf_counter()
+            deleted = run_retention()
+            freed = compact_database()
+            log_event("retention_finished", deleted=deleted, freed_pages=freed,
+                      seconds=round(time.perf_counter() - started, 3))
+        except Exception as e:
+            log_event("retention_failed", level="error", error=str(e))
+
+
+def start_retention():
+    """Apply the retention policies every RETENTION_INTERVAL seconds in a background thread"""
+    if RETENTION_INTERVAL > 0:
+        threading.Thread(target=_retention_loop, name="retention", daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply the retention policies once and compact the database")
+    parser.add_argument("--vacuum", action="store_true",
+                        help="rebuild the database with a full VACUUM (also enables incremental auto_vacuum)")
+    args = parser.parse_args()
+
+    init_db()
+    deleted = run_retention()
+    freed = compact_database(full=args.vacuum)
+    mode, free_pages, page_count = get_vacuum_state()
+    print(f"Deleted rows: {deleted or 'no policies enabled'}")
+    print(f"Freed {freed} pages; {page_count} pages in use, {free_pages} free, auto_vacuum mode {mode}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
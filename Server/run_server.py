@@ -1,23 +1,26 @@
 import socket
-import ssl
 import threading
 import time
 import signal
 import sys
 import os
 from dotenv import load_dotenv
-from generate_cert import generate_self_signed_cert
+from generate_cert import create_server_ssl_context
 from auth_utils import handle_client
-from db_utils import init_db
+from db_utils import init_db, flush_image_cache
+from image_utils import flush_persisted_images, start_blob_gc
+from inference_scheduler import start_model_loading, stop_model
+from metrics_utils import CONNECTIONS_TOTAL, MAX_HANDLERS, start_metrics_server
+from profiler_utils import install_profile_signal
+from retention_utils import start_retention
 
 load_dotenv()
 
 HOST = "0.0.0.0"
 PORT = 12378
 MAX_THREADS = 5
-IMAGE_DIR = 'images'
-if not os.path.exists(IMAGE_DIR):
-    os.makedirs(IMAGE_DIR)
+# "threaded" (one thread per connection) or "asyncio" (event loop with bounded executors)
+SERVER_MODE = os.getenv("SERVER_MODE", "threaded")
 
 semaphore = threading.Semaphore(MAX_THREADS)
 
@@ -43,6 +46,11 @@ def signal_handler(sig, frame):
         except:
             pass
 
+    # Finish writing uploads and history rows that are still queued
+    flush_persisted_images()
+    flush_image_cache()
+    stop_model()
+
     # Wait a moment for threads to finish
     time.sleep(1)
     print("[Server] Server shutdown complete.")
@@ -55,23 +63,29 @@ def start_server():
     # Set up signal handlers
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    # SIGUSR1 captures a sampling profile of the live server
+    install_profile_signal()
 
     init_db()
 
-    # Generate or load the certificate
-    cert_file, key_file = generate_self_signed_cert()
-
-    # Set up SSL context
-    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    context.load_cert_chain(certfile=cert_file, keyfile=key_file)
+    # Set up SSL context with a generated or existing certificate
+    context = create_server_ssl_context()
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind((HOST, PORT))
     server_socket.listen(5)
-    server_socket = context.wrap_socket(server_socket, server_side=True)
+    # Handshakes run in the client threads (see handle_client), not in this accept loop
+    server_socket = context.wrap_socket(server_socket, server_side=True, do_handshake_on_connect=False)
 
     print(f"[Server] Listening on {HOST}:{PORT} with SSL...")
+    MAX_HANDLERS.set(MAX_THREADS)
+    start_metrics_server()
+    start_blob_gc()
+    start_retention()
+
+    # Serve logins and history right away while the model loads
+    start_model_loading()
 
     client_threads = []
 
@@ -82,6 +96,7 @@ def start_server():
                 server_socket.settimeout(1.0)
                 try:
                     client_socket, client_address = server_socket.accept()
+                    CONNECTIONS_TOTAL.inc()
                     client_thread = threading.Thread(target=handle_client, args=(client_socket, client_address, semaphore))
                     client_thread.daemon = True  # Set as daemon so it won't block shutdown
                     client_thread.start()
@@ -110,4 +125,8 @@ def start_server():
 
 
 if __name__ == '__main__':
-    start_server()
+    if '--async' in sys.argv or SERVER_MODE == "asyncio":
+        from async_server import start_async_server
+        start_async_server(HOST, PORT)
+    else:
+        start_server()
@@ -0,0 +1,45 @@
+"""Latency and memory statistics shared by the load test and the benchmark scripts.
+
+Standard library only, so either script can import it without the other's dependencies.
+"""
+import math
+import sys
+
+# Function declarations:
+# def percentile(sorted_values: list[float], fraction: float) -> float
+# def summarize(samples: list[float]) -> dict
+# def peak_rss_mb() -> float | None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    # Smallest value with at least fraction of the samples at or below it; rounding first
+    # keeps float noise such as 0.07 * 100 = 7.000000000000001 from skipping a rank
+    rank = max(0, math.ceil(round(fraction * len(sorted_values), 9)) - 1)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values) * 1000 if values else None,
+        "p50_ms": percentile(values, 0.50) * 1000 if values else None,
+        "p95_ms": percentile(values, 0.95) * 1000 if values else None,
+        "p99_ms": percentile(values, 0.99) * 1000 if values else None,
+        "max_ms": values[-1] * 1000 if values else None,
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB; it only ever grows, so later runs include earlier peaks"""
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
@@ -0,0 +1,38 @@
+"""Checks for the nearest-rank percentiles in stats_utils.
+
+Usage: python -m unittest test_stats_utils
+"""
+import unittest
+from stats_utils import percentile, summarize
+
+
+class PercentileTest(unittest.TestCase):
+    def test_one_to_ten(self):
+        values = list(range(1, 11))
+        self.assertEqual(percentile(values, 0.50), 5)
+        self.assertEqual(percentile(values, 0.90), 9)
+        self.assertEqual(percentile(values, 0.95), 10)
+        self.assertEqual(percentile(values, 0.99), 10)
+
+    def test_one_to_hundred(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.07), 7)
+        self.assertEqual(percentile(values, 0.50), 50)
+        self.assertEqual(percentile(values, 0.95), 95)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertEqual(percentile(values, 1.0), 100)
+
+    def test_edges(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([3], 0.0), 3)
+        self.assertEqual(percentile([3], 0.99), 3)
+
+    def test_summarize_in_milliseconds(self):
+        summary = summarize([i / 1000 for i in range(10, 0, -1)])
+        self.assertEqual(summary["count"], 10)
+        self.assertAlmostEqual(summary["p50_ms"], 5)
+        self.assertAlmostEqual(summary["max_ms"], 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
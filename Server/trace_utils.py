@@ -0,0 +1,145 @@
+"""Request-scoped tracing and structured JSON logging.
+
+Every request gets a Trace with an ID and a list of timed spans. log_event writes one JSON
+object per line to stdout and tags it with the ID of the trace active in the calling thread
+or task, so all lines of one request can be grepped together. Requests slower than
+TRACE_SLOW_MS are also appended, with all their spans, to TRACE_SLOW_LOG.
+"""
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Requests at least this slow are written to the slow request log
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 5000))
+TRACE_SLOW_LOG = os.getenv("TRACE_SLOW_LOG", "slow_requests.jsonl")
+# Fraction of slow requests written, so a stall under heavy load cannot flood the disk
+TRACE_SLOW_SAMPLE_RATE = float(os.getenv("TRACE_SLOW_SAMPLE_RATE", 1.0))
+
+# Function declarations:
+# class Trace(kind: str, **fields)
+# def current_trace() -> Trace | None
+# def activate(trace: Trace) -> ContextManager
+# def call_in_trace(trace: Trace, func: callable, *args) -> object
+# def span(name: str, **fields) -> ContextManager
+# def record_span(name: str, started: float, finished: float, **fields) -> None
+# def log_event(event: str, level: str = "info", **fields) -> None
+
+_current = contextvars.ContextVar("trace", default=None)
+_output_lock = threading.Lock()
+_slow_log_lock = threading.Lock()
+
+
+class Trace:
+    """Timed spans of one request; times are perf_counter seconds, reported relative to the start"""
+
+    def __init__(self, kind, **fields):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.spans = []
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def record(self, name, started, finished, **fields):
+        entry = {"name": name, "start_ms": round((started - self.started) * 1000, 3),
+                 "duration_ms": round((finished - started) * 1000, 3)}
+        entry.update(fields)
+        with self._lock:
+            self.spans.append(entry)
+
+    @contextmanager
+    def span(self, name, **fields):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter(), **fields)
+
+    def finish(self, **fields):
+        """Log the request with its spans (once) and sample it to the slow log if needed"""
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.fields.update(fields)
+            spans = sorted(self.spans, key=lambda entry: entry["start_ms"])
+        total_ms = round((time.perf_counter() - self.started) * 1000, 3)
+        record = {"trace_id": self.id, "kind": self.kind, "total_ms": total_ms, **self.fields, "spans": spans}
+        log_event("request_finished", **record)
+        if total_ms >= TRACE_SLOW_MS and random.random() < TRACE_SLOW_SAMPLE_RATE:
+            _write_slow_request(record)
+
+
+def _write_slow_request(record):
+    line = json.dumps({"ts": _timestamp(), **record}, default=str)
+    try:
+        with _slow_log_lock, open(TRACE_SLOW_LOG, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        log_event("slow_log_write_failed", level="error", error=str(e))
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def activate(trace):
+    """Make trace the current trace of this thread (or asyncio task) for the with block"""
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+def call_in_trace(trace, func, *args):
+    """Run func with trace active; executor threads do not inherit the submitting thread's trace"""
+    with activate(trace):
+        return func(*args)
+
+
+@contextmanager
+def span(name, **fields):
+    """Time the with block as a span of the current trace (a no-op outside a request)"""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    with trace.span(name, **fields):
+        yield
+
+
+def record_span(name, started, finished, **fields):
+    """Add a span measured elsewhere, e.g. by another thread, to the current trace"""
+    trace = _current.get()
+    if trace is not None:
+        trace.record(name, started, finished, **fields)
+
+
+def _timestamp():
+    now = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(now)) + f".{int(now % 1 * 1000):03d}"
+
+
+def log_event(event, level="info", **fields):
+    """Write one structured log line to stdout"""
+    record = {"ts": _timestamp(), "level": level, "event": event}
+    trace = _current.get()
+    if trace is not None and "trace_id" not in fields:
+        record["trace_id"] = trace.id
+    record.update(fields)
+    line = json.dumps(record, default=str)
+    with _output_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
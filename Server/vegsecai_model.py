@@ -1,23 +1,214 @@
-from PIL import Image
-from transformers import AutoTokenizer
-from moondream.hf import LATEST_REVISION, Moondream, detect_device
-
-device, dtype = detect_device()
-
-model_id = "vikhyatk/moondream2"
-tokenizer = AutoTokenizer.from_pretrained(model_id, revision=LATEST_REVISION)
-moondream = Moondream.from_pretrained(
-    model_id,
-    revision=LATEST_REVISION,
-    torch_dtype=dtype,
-    ignore_mismatched_sizes=True
-).to(device=device)
-moondream.eval()
-
-def query_ai(image_path, prompt="What is this?"):
-    image = Image.open(image_path)
-    image_embeds = moondream.encode_image(image)
-    answer = moondream.answer_question(image_embeds, prompt, tokenizer)
-
-    return answer
-
+import os
+import warnings
+import numpy as np
+import torch
+from transformers import AutoTokenizer
+from moondream.hf import LATEST_REVISION, Moondream, detect_device
+from cache_utils import LRUCache
+from image_utils import EMBEDDING_DIR
+from trace_utils import log_event
+
+# Image embedding cache configuration
+EMBEDDING_CACHE_BYTES = int(os.getenv("EMBEDDING_CACHE_BYTES", 256 * 1024 * 1024))  # 256 MB in memory
+
+# CPU inference configuration
+# auto keeps fp32 on CPU and the device default on GPUs; bf16 and int8 must be chosen explicitly
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "auto")  # auto, fp32, bf16 or int8
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", 0))  # 0 keeps the torch default
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", 0))
+PRECISION_MODES = ("auto", "fp32", "bf16", "int8")
+INFERENCE_DEVICE = os.getenv("INFERENCE_DEVICE", "auto")  # auto, cpu, cuda or mps
+
+model_id = "vikhyatk/moondream2"
+
+# Populated by load_model()
+device, dtype = None, None
+precision = None
+tokenizer = None
+moondream = None
+embedding_dir = None  # EMBEDDING_DIR/<revision>-<device>-<precision>
+
+# Content-addressed embeddings: in-memory LRU backed by .npy files under embedding_dir
+embedding_cache = LRUCache(
+    max_bytes=EMBEDDING_CACHE_BYTES,
+    sizeof=lambda tensor: tensor.element_size() * tensor.nelement()
+)
+
+# Function declarations:
+# def cpu_supports_bf16() -> bool
+# def configure_torch_threads() -> None
+# def load_model(precision_mode: str = INFERENCE_PRECISION, device_name: str = INFERENCE_DEVICE) -> None
+# def load_embedding(image_hash: str) -> torch.Tensor | None
+# def save_embedding(image_hash: str, image_embeds: torch.Tensor) -> None
+# def get_image_embeds(image: Image.Image, image_hash: str) -> torch.Tensor
+# def query_ai(image: Image.Image, prompt: str = "What is this?", image_hash: str | None = None) -> str
+# def batch_query_ai(requests: list[tuple[Image.Image, str, str]]) -> list[str]
+
+
+def cpu_supports_bf16():
+    """Check whether the CPU has native bfloat16 instructions (AVX-512 BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def configure_torch_threads():
+    if TORCH_NUM_THREADS > 0:
+        torch.set_num_threads(TORCH_NUM_THREADS)
+    if TORCH_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            log_event("interop_threads_not_set", level="warning", error=str(e))
+
+
+def load_model(precision_mode=INFERENCE_PRECISION, device_name=INFERENCE_DEVICE):
+    """Download (if needed) and load the tokenizer and Moondream weights"""
+    global device, dtype, precision, tokenizer, moondream, embedding_dir
+    if precision_mode not in PRECISION_MODES:
+        raise ValueError(f"Unknown inference precision {precision_mode!r}, expected one of {PRECISION_MODES}")
+
+    configure_torch_threads()
+    if device_name == "auto":
+        device, dtype = detect_device()
+    else:
+        device = torch.device(device_name)
+        dtype = torch.float32 if device.type == 'cpu' else torch.float16
+    on_cpu = torch.device(device).type == 'cpu'
+
+    # Reduced precision modes only apply to CPU inference; GPUs keep detect_device()'s dtype
+    precision = "default"
+    if on_cpu:
+        if precision_mode == "bf16":
+            if not cpu_supports_bf16():
+                log_event("bf16_emulated", level="warning",
+                          reason="the CPU has no native bfloat16 instructions; inference will be slower than fp32")
+            dtype, precision = torch.bfloat16, "bf16"
+        else:
+            # Dynamic int8 quantization starts from fp32 weights
+            dtype = torch.float32
+            precision = "int8" if precision_mode == "int8" else "fp32"
+    elif precision_mode == "fp32":
+        dtype, precision = torch.float32, "fp32"
+
+    tokenizer = AutoTokenizer.from_pretrained(model_id, revision=LATEST_REVISION)
+    model = Moondream.from_pretrained(
+        model_id,
+        revision=LATEST_REVISION,
+        torch_dtype=dtype,
+        ignore_mismatched_sizes=True
+    ).to(device=device)
+    model.eval()
+
+    if precision == "int8":
+        # Weights of every nn.Linear become int8; activations are quantized on the fly
+        # in place, so the fp32 weights are not copied and peak memory stays near one model
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    moondream = model
+    # Embeddings from another revision, device or precision do not match this encoder's output
+    label = precision if precision != "default" else str(dtype).replace("torch.", "")
+    embedding_dir = os.path.join(EMBEDDING_DIR, f"{LATEST_REVISION}-{torch.device(device).type}-{label}")
+    os.makedirs(embedding_dir, exist_ok=True)
+    embedding_cache.clear()
+    log_event("model_loaded", device=str(device), precision=precision, intra_op_threads=torch.get_num_threads(),
+              inter_op_threads=torch.get_num_interop_threads())
+
+
+def load_embedding(image_hash):
+    """Load an image embedding from memory or its memory-mapped .npy file"""
+    image_embeds = embedding_cache.get(image_hash)
+    if image_embeds is not None:
+        return image_embeds
+
+    embedding_path = os.path.join(embedding_dir, f"{image_hash}.npy")
+    if not os.path.exists(embedding_path):
+        return None
+
+    try:
+        array = np.load(embedding_path, mmap_mode='r')
+        with warnings.catch_warnings():
+            # The mapping is read-only; the model never writes into image embeddings
+            warnings.simplefilter("ignore", UserWarning)
+            image_embeds = torch.from_numpy(array).to(device=device, dtype=dtype)
+    except Exception as e:
+        log_event("embedding_discarded", level="warning", path=embedding_path, error=str(e))
+        os.remove(embedding_path)
+        return None
+
+    embedding_cache.put(image_hash, image_embeds)
+    return image_embeds
+
+
+def save_embedding(image_hash, image_embeds):
+    """Store an image embedding in memory and on disk"""
+    embedding_cache.put(image_hash, image_embeds)
+
+    embedding_path = os.path.join(embedding_dir, f"{image_hash}.npy")
+    if os.path.exists(embedding_path):
+        return
+
+    # numpy has no bfloat16, so embeddings are stored as float32 and cast back on load
+    temp_path = f"{embedding_path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        np.save(f, image_embeds.detach().to(dtype=torch.float32).cpu().numpy())
+    os.replace(temp_path, embedding_path)
+
+
+def get_image_embeds(image, image_hash):
+    """Return the vision encoder output for an image, running encode_image only on a cache miss"""
+    image_embeds = load_embedding(image_hash)
+    if image_embeds is None:
+        with torch.no_grad():
+            image_embeds = moondream.encode_image(image)
+        save_embedding(image_hash, image_embeds)
+    return image_embeds
+
+
+def query_ai(image, prompt="What is this?", image_hash=None):
+    # Without a content hash there is nothing to key the embedding cache on
+    if image_hash is None:
+        with torch.no_grad():
+            image_embeds = moondream.encode_image(image)
+    else:
+        image_embeds = get_image_embeds(image, image_hash)
+    answer = moondream.answer_question(image_embeds, prompt, tokenizer)
+
+    return answer
+
+
+def batch_query_ai(requests):
+    """Answer several (image, prompt, image_hash) requests with one batched encoder pass"""
+    embeds_by_hash = {}
+    pending_images = {}
+    for image, _, image_hash in requests:
+        if image_hash in embeds_by_hash or image_hash in pending_images:
+            continue
+        image_embeds = load_embedding(image_hash)
+        if image_embeds is None:
+            pending_images[image_hash] = image
+        else:
+            embeds_by_hash[image_hash] = image_embeds
+
+    # Encode every uncached image in the batch with a single forward pass
+    if pending_images:
+        hashes = list(pending_images)
+        images = [pending_images[image_hash] for image_hash in hashes]
+        with torch.no_grad():
+            batch_embeds = moondream.encode_image(images)
+        for i, image_hash in enumerate(hashes):
+            # Copy the slice so the cache does not keep the whole batch tensor alive
+            image_embeds = batch_embeds[i:i + 1].clone()
+            save_embedding(image_hash, image_embeds)
+            embeds_by_hash[image_hash] = image_embeds
+
+    # The decoder still runs once per prompt: batch_answer() re-encodes its images,
+    # which would bypass the embedding cache
+    return [
+        moondream.answer_question(embeds_by_hash[image_hash], prompt, tokenizer)
+        for _, prompt, image_hash in requests
+    ]
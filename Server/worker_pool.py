@@ -0,0 +1,263 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+from dotenv import load_dotenv
+from trace_utils import log_event
+
+load_dotenv()
+
+# Number of model processes; 0 runs inference inside the server process
+INFERENCE_PROCESSES = int(os.getenv("INFERENCE_PROCESSES", 0))
+# Seconds to wait before replacing a crashed worker, doubling after each failed restart up to the
+# maximum, and for an idle worker to free up
+WORKER_RESTART_DELAY = float(os.getenv("WORKER_RESTART_DELAY", 1.0))
+WORKER_RESTART_MAX_DELAY = float(os.getenv("WORKER_RESTART_MAX_DELAY", 60))
+WORKER_ACQUIRE_TIMEOUT = float(os.getenv("WORKER_ACQUIRE_TIMEOUT", 120))
+
+# Function declarations:
+# def split_cpus(count: int) -> list[list[int]]
+# def worker_main(conn, cpus: list[int], index: int) -> None
+# class ModelWorker(index: int, cpus: list[int])
+# class ModelWorkerPool(num_processes: int)
+
+
+class ModelNotReadyError(Exception):
+    """Raised when an image request arrives before the model has finished loading,
+    or while every model process is down"""
+
+
+class WorkerCrashedError(Exception):
+    """Raised when a model process dies while answering a batch"""
+
+
+def split_cpus(count):
+    """Divide the CPUs this process may use into count contiguous, non-overlapping subsets"""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = list(range(os.cpu_count() or 1))
+    if count >= len(cpus):
+        # More workers than cores: each worker gets one core, shared round-robin
+        return [[cpus[i % len(cpus)]] for i in range(count)]
+    size, extra = divmod(len(cpus), count)
+    subsets, start = [], 0
+    for i in range(count):
+        end = start + size + (1 if i < extra else 0)
+        subsets.append(cpus[start:end])
+        start = end
+    return subsets
+
+
+def _read_shared_image(name, width, height):
+    from PIL import Image
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        # copy() detaches the pixels from the block so it can be closed straight away
+        return Image.frombuffer('RGB', (width, height), block.buf, 'raw', 'RGB', 0, 1).copy()
+    finally:
+        block.close()
+
+
+def worker_main(conn, cpus, index):
+    """Entry point of a model process: load the model, then answer batches sent over conn"""
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    # Size torch's pool to the pinned cores unless the operator chose explicitly
+    os.environ.setdefault("TORCH_NUM_THREADS", str(len(cpus)))
+
+    try:
+        import vegsecai_model
+        vegsecai_model.load_model()
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            batch = conn.recv()
+        except EOFError:
+            break
+        if batch is None:
+            break
+
+        try:
+            requests = [(_read_shared_image(name, width, height), prompt, image_hash)
+                        for name, width, height, prompt, image_hash in batch]
+            conn.send(("ok", vegsecai_model.batch_query_ai(requests)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class ModelWorker:
+    """One model process pinned to a CPU subset, and the server's end of its pipe"""
+
+    def __init__(self, index, cpus):
+        self.index = index
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        # Spawned rather than forked: torch and the server's threads are not fork-safe
+        context = multiprocessing.get_context('spawn')
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child_conn, self.cpus, self.index),
+                                       name=f"model-worker-{self.index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def wait_ready(self):
+        """Block until the model has loaded, raising RuntimeError if it could not"""
+        try:
+            status, detail = self.conn.recv()
+        except EOFError:
+            raise RuntimeError(f"exited with code {self.process.exitcode} while loading the model")
+        if status != "ready":
+            raise RuntimeError(detail)
+
+    def run_batch(self, requests):
+        """Hand (image, prompt, image_hash) requests to the process and wait for its answers"""
+        blocks, batch = [], []
+        try:
+            for image, prompt, image_hash in requests:
+                pixels = image.convert('RGB').tobytes()
+                block = shared_memory.SharedMemory(create=True, size=max(1, len(pixels)))
+                blocks.append(block)
+                block.buf[:len(pixels)] = pixels
+                batch.append((block.name, image.width, image.height, prompt, image_hash))
+
+            try:
+                self.conn.send(batch)
+                status, result = self.conn.recv()
+            except (EOFError, OSError):
+                self.process.join(timeout=1.0)
+                raise WorkerCrashedError(f"Model worker {self.index} crashed (exit code {self.process.exitcode})")
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        if status != "ok":
+            raise RuntimeError(result)
+        return result
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout=5.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ModelWorkerPool:
+    """Pool of model processes fed by the inference scheduler; crashed workers are replaced"""
+
+    def __init__(self, num_processes):
+        self.workers = [ModelWorker(i, cpus) for i, cpus in enumerate(split_cpus(num_processes))]
+        self.idle = queue.Queue()
+        self.ready = threading.Event()
+        self.load_error = None
+        self._failed = 0
+        self._alive = 0  # workers that have loaded the model and not crashed since
+        self._lock = threading.Lock()
+        self._stopping = False
+
+    def start(self):
+        """Start every worker; each loads its own copy of the model in parallel"""
+        for worker in self.workers:
+            threading.Thread(target=self._start_worker, args=(worker,),
+                             name=f"start-model-worker-{worker.index}", daemon=True).start()
+
+    def _start_worker(self, worker):
+        """Start one worker and wait for its model; returns whether it came up"""
+        worker.start()
+        try:
+            worker.wait_ready()
+        except Exception as e:
+            log_event("model_worker_failed", level="error", worker=worker.index, error=str(e))
+            worker.stop()
+            with self._lock:
+                self.load_error = e
+                self._failed += 1
+                all_failed = self._failed == len(self.workers)
+            if all_failed:
+                # Wake wait_ready() so callers can report the failure
+                self.ready.set()
+            return False
+
+        with self._lock:
+            # A worker that recovers makes the pool usable again
+            self.load_error = None
+            self._failed = 0
+            self._alive += 1
+        log_event("model_worker_ready", worker=worker.index, cpus=worker.cpus)
+        self.idle.put(worker)
+        self.ready.set()
+        return True
+
+    def _restart(self, worker):
+        """Replace a crashed worker, retrying with exponential backoff until it comes up"""
+        worker.stop()
+        delay = WORKER_RESTART_DELAY
+        attempt = 1
+        while not self._stopping:
+            time.sleep(delay)
+            if self._stopping:
+                return
+            log_event("model_worker_restarting", worker=worker.index, attempt=attempt)
+            if self._start_worker(worker):
+                return
+            delay = min(delay * 2, WORKER_RESTART_MAX_DELAY)
+            attempt += 1
+
+    def _acquire(self):
+        """Take an idle worker, failing fast once no worker is left to free up"""
+        deadline = time.monotonic() + WORKER_ACQUIRE_TIMEOUT
+        while True:
+            if self._alive == 0:
+                raise ModelNotReadyError("The AI model is restarting. Please try again in a moment.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError("No model worker is available")
+            try:
+                # Short waits so batches already queued notice when the last worker crashes
+                return self.idle.get(timeout=min(remaining, 0.5))
+            except queue.Empty:
+                pass
+
+    def wait_ready(self, timeout=None):
+        """Wait until at least one worker can take requests"""
+        self.ready.wait(timeout)
+        return self.ready.is_set() and self.load_error is None
+
+    def run_batch(self, requests):
+        worker = self._acquire()
+        try:
+            results = worker.run_batch(requests)
+        except WorkerCrashedError as e:
+            # Replace the process in the background; this batch fails and the client can retry
+            with self._lock:
+                self._alive -= 1
+            log_event("model_worker_crashed", level="error", worker=worker.index, error=str(e))
+            threading.Thread(target=self._restart, args=(worker,),
+                             name=f"restart-model-worker-{worker.index}", daemon=True).start()
+            raise
+        except Exception:
+            self.idle.put(worker)
+            raise
+        self.idle.put(worker)
+        return results
+
+    def shutdown(self):
+        self._stopping = True
+        for worker in self.workers:
+            worker.stop()